@@ -0,0 +1,310 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+import database
+import nhtsa_api
+from crash import create_counties_table, create_crashes_table, fetch_and_insert_crashes_bulk
+from crash_details import (add_detail_columns, create_crash_details_table, create_intersection_types_table,
+                           fetch_and_insert_crash_details_concurrent)
+from daily_stats import create_daily_crash_stats_table, rebuild_daily_crash_stats
+from graph import CHARTS, fetch_crash_details_data, analyze_crash_details
+from migrations import migrate
+from payloads import create_case_payloads_table
+from weather import create_database_table
+
+INTERSECTION_TYPES = [
+    'Not an Intersection', 'Four-Way Intersection', 'T-Intersection', 'Not Reported',
+    'Roundabout', 'Y-Intersection', 'Five Point, or More',
+]
+
+# Michigan has 83 counties, numbered with odd FIPS codes
+COUNTY_CODES = list(range(1, 167, 2))
+
+# Synthetic crashes and weather cover these day keys (2010-01-01 to 2023-12-31)
+FIRST_DAY = 14610
+LAST_DAY = 19722
+
+# Rows generated and inserted per executemany
+CHUNK_ROWS = 200_000
+
+def create_tables(cursor):
+    """Create every table the ingest and analysis code use"""
+    create_counties_table(cursor)
+    create_crashes_table(cursor)
+    create_crash_details_table(cursor)
+    create_intersection_types_table(cursor)
+    create_database_table(cursor)
+    create_daily_crash_stats_table(cursor)
+    create_case_payloads_table(cursor)
+    add_detail_columns(cursor)
+
+def generate_dimensions(cursor):
+    """Fill counties and intersection_types"""
+    cursor.executemany('INSERT INTO counties (State, county_name) VALUES (26, ?)',
+                       [(f"COUNTY {code} ({code})",) for code in COUNTY_CODES])
+    cursor.executemany('INSERT INTO intersection_types (type_name) VALUES (?)',
+                       [(name,) for name in INTERSECTION_TYPES])
+
+def generate_weather(cursor, seed=0):
+    """Fill daily_data_meteostat with a seasonal temperature for every synthetic day"""
+    rng = np.random.default_rng(seed)
+    days = np.arange(FIRST_DAY, LAST_DAY + 1)
+    # Detroit swings between about 25F in January and 75F in July
+    temperature_avg = 50 - 25 * np.cos(2 * np.pi * (days - 15) / 365.25) + rng.normal(0, 7, len(days))
+    spread = rng.uniform(5, 12, len(days))
+    cursor.executemany('''
+        INSERT INTO daily_data_meteostat (date, temperature_avg, temperature_min, temperature_max, day)
+        VALUES (date(? * 86400, 'unixepoch'), ?, ?, ?, ?)
+    ''', zip(days.tolist(), temperature_avg.round(1).tolist(), (temperature_avg - spread).round(1).tolist(),
+             (temperature_avg + spread).round(1).tolist(), days.tolist()))
+
+def generate_crashes(cursor, num_rows, seed=0):
+    """Fill crashes and crash_details with num_rows synthetic crashes each"""
+    rng = np.random.default_rng(seed)
+    for start in range(0, num_rows, CHUNK_ROWS):
+        size = min(CHUNK_ROWS, num_rows - start)
+        ids = np.arange(start + 1, start + size + 1)
+        days = rng.integers(FIRST_DAY, LAST_DAY + 1, size)
+        seconds = days * 86400 + rng.integers(0, 86400, size)
+        years = (days.astype('datetime64[D]').astype('datetime64[Y]').astype(np.int64) + 1970)
+        # FARS only records crashes with a death, so every crash has at least one fatality
+        cursor.executemany('''
+            INSERT INTO crashes
+                (id, county_id, epoch, year, Fatals, Peds, Persons, St_Case, State, TotalVehicles, day)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 26, ?, ?)
+        ''', zip(ids.tolist(), rng.integers(1, len(COUNTY_CODES) + 1, size).tolist(), seconds.tolist(),
+                 years.tolist(),
+                 rng.choice([1, 1, 1, 1, 2, 3], size).tolist(), rng.choice([0, 0, 0, 1], size).tolist(),
+                 rng.integers(1, 6, size).tolist(), (260000 + ids).tolist(), rng.integers(1, 5, size).tolist(),
+                 days.tolist()))
+        # 1970-01-01 was a Thursday, weekday 4 with Monday as 1
+        cursor.executemany('INSERT INTO crash_details (id, drunk, weekday, type_id) VALUES (?, ?, ?, ?)',
+                           zip(ids.tolist(), rng.choice([0, 0, 0, 1, 2], size).tolist(),
+                               ((days + 3) % 7 + 1).tolist(),
+                               rng.integers(1, len(INTERSECTION_TYPES) + 1, size).tolist()))
+
+def generate_dataset(conn, num_rows, seed=0):
+    """Build a complete synthetic database with num_rows crashes and return the seconds each step took"""
+    cursor = conn.cursor()
+    timings = {}
+
+    start = time.perf_counter()
+    create_tables(cursor)
+    generate_dimensions(cursor)
+    generate_weather(cursor, seed)
+    generate_crashes(cursor, num_rows, seed)
+    conn.commit()
+    timings['generate'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rebuild_daily_crash_stats(cursor)
+    conn.commit()
+    timings['aggregate'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # Ingest state and the analysis indexes
+    migrate(conn)
+    timings['migrate'] = time.perf_counter() - start
+    return timings
+
+def best_time(func, repeat):
+    """Run func repeat times and return its fastest time and last result"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def bench_queries(conn, repeat=3):
+    """Time each graph.py fetch and analysis function on a database"""
+    cursor = conn.cursor()
+    timings = {}
+    for name, (fetch, _) in CHARTS.items():
+        timings[f'fetch_{name}'], _ = best_time(lambda: fetch(cursor), repeat)
+    timings['fetch_crash_details'], data = best_time(lambda: fetch_crash_details_data(cursor), repeat)
+    timings['analyze_crash_details'], _ = best_time(lambda: analyze_crash_details(data), repeat)
+    return timings
+
+def bench_dataset(num_rows, repeat=3, seed=0):
+    """Generate a synthetic database of num_rows crashes and time the analysis queries on it"""
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = database.connect(os.path.join(tmp, 'bench.db'))
+        timings = generate_dataset(conn, num_rows, seed)
+        timings.update(bench_queries(conn, repeat))
+        conn.close()
+    return timings
+
+class NHTSAStubHandler(BaseHTTPRequestHandler):
+    """Answer GetCaseList and GetCaseDetails with synthetic Michigan crashes"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path.endswith('/GetCaseList'):
+            body = self.case_list(int(params['fromYear']))
+        elif url.path.endswith('/GetCaseDetails'):
+            body = self.case_details(int(params['stateCase']))
+        else:
+            self.send_error(404)
+            return
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def case_list(self, year):
+        """GetCaseList response with server.cases_per_year crashes spread over the year"""
+        num_cases = self.server.cases_per_year
+        year_start = int((datetime(year, 1, 1) - datetime(1970, 1, 1)).total_seconds())
+        cases = [{
+            "CountyName": f"COUNTY {COUNTY_CODES[i % len(COUNTY_CODES)]} ({COUNTY_CODES[i % len(COUNTY_CODES)]})",
+            "CrashDate": f"/Date({(year_start + i * 31_536_000 // num_cases) * 1000}-0500)/",
+            "Fatals": 1 + i % 3 // 2,
+            "Peds": i % 4 // 3,
+            "Persons": 1 + i % 5,
+            "St_Case": 260000 + i,
+            "State": 26,
+            "TotalVehicles": 1 + i % 4,
+        } for i in range(num_cases)]
+        return {"Count": num_cases, "Message": "Results returned successfully", "Results": [cases]}
+
+    def case_details(self, state_case):
+        """GetCaseDetails response for one crash"""
+        crash = {
+            "DRUNK_DR": state_case % 5 // 3,
+            "TYP_INTNAME": INTERSECTION_TYPES[state_case % len(INTERSECTION_TYPES)],
+            "DAY_WEEK": state_case % 7 + 1,
+            "LGT_CONDNAME": ("Daylight", "Dark - Lighted", "Dark - Not Lighted")[state_case % 3],
+            "WEATHERNAME": ("Clear", "Cloudy", "Rain", "Snow")[state_case % 4],
+            "VE_TOTAL": 1 + state_case % 4,
+        }
+        return {"Count": 1, "Message": "Results returned successfully", "Results": [[{"CrashResultSet": crash}]]}
+
+def start_stub(cases_per_year):
+    """Start the NHTSA stub on a free local port and return the server"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), NHTSAStubHandler)
+    server.cases_per_year = cases_per_year
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def bench_ingest(num_cases, num_details, workers=8):
+    """Time the bulk crash ingest and the concurrent details ingest against the local stub"""
+    server = start_stub(num_cases)
+    api_url, cache_path = nhtsa_api.API_URL, nhtsa_api.CACHE_PATH
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        nhtsa_api.API_URL = f"http://127.0.0.1:{server.server_address[1]}/CrashAPI"
+        nhtsa_api.set_cache_path(os.path.join(tmp, 'cache.sqlite'))
+        conn = database.connect(os.path.join(tmp, 'ingest.db'))
+        cursor = conn.cursor()
+        try:
+            create_tables(cursor)
+            conn.commit()
+            migrate(conn)
+
+            start = time.perf_counter()
+            fetch_and_insert_crashes_bulk(conn, cursor, 2020, 2020)
+            elapsed = time.perf_counter() - start
+            rows = cursor.execute('SELECT COUNT(*) FROM crashes').fetchone()[0]
+            results['crashes_bulk'] = {'rows': rows, 'seconds': elapsed, 'rows_per_second': rows / elapsed}
+
+            # Details take one request per crash, so only the first num_details crashes are fetched
+            cursor.execute('DELETE FROM crashes WHERE id > ?', (num_details,))
+            conn.commit()
+            start = time.perf_counter()
+            fetch_and_insert_crash_details_concurrent(conn, cursor, max_workers=workers, rate=1e9,
+                                                      base_url=nhtsa_api.API_URL + "/crashes/GetCaseDetails")
+            elapsed = time.perf_counter() - start
+            rows = cursor.execute('SELECT COUNT(*) FROM crash_details').fetchone()[0]
+            results['crash_details_concurrent'] = {'rows': rows, 'seconds': elapsed,
+                                                   'rows_per_second': rows / elapsed}
+        finally:
+            conn.close()
+            nhtsa_api.API_URL = api_url
+            nhtsa_api.set_cache_path(cache_path)
+            server.shutdown()
+    return results
+
+def git_commit():
+    """Return the commit being benchmarked, or None outside a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_reports(previous, current):
+    """Print each timing of current next to the same timing in previous"""
+    for size, timings in current['datasets'].items():
+        old = previous.get('datasets', {}).get(size, {})
+        for name, seconds in timings.items():
+            if old.get(name):
+                print(f"{size:>10} {name:<40} {old[name]:9.3f}s -> {seconds:9.3f}s ({seconds / old[name]:5.2f}x)")
+    for name, result in current['ingest'].items():
+        old = previous.get('ingest', {}).get(name)
+        if old:
+            print(f"{'ingest':>10} {name:<40} {old['rows_per_second']:9,.0f}/s -> "
+                  f"{result['rows_per_second']:9,.0f}/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest and analysis on synthetic data")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 1_000_000, 10_000_000],
+                        help="numbers of synthetic crashes to generate and query")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per query, the fastest is reported")
+    parser.add_argument('--ingest-cases', type=int, default=10_000,
+                        help="crashes the stub returns for the bulk ingest, 0 to skip the ingest benchmarks")
+    parser.add_argument('--ingest-details', type=int, default=1_000, help="crashes to fetch details for")
+    parser.add_argument('--workers', type=int, default=8, help="detail requests in flight")
+    parser.add_argument('--output', default='benchmark_report.json', help="where to write the JSON report")
+    parser.add_argument('--compare', help="earlier JSON report to compare the timings against")
+    args = parser.parse_args()
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'datasets': {},
+        'ingest': {},
+    }
+    for num_rows in args.sizes:
+        timings = bench_dataset(num_rows, args.repeat)
+        report['datasets'][str(num_rows)] = timings
+        for name, seconds in timings.items():
+            print(f"{num_rows:>10,} crashes {name:<40} {seconds:9.3f}s")
+
+    if args.ingest_cases:
+        report['ingest'] = bench_ingest(args.ingest_cases, args.ingest_details, args.workers)
+        for name, result in report['ingest'].items():
+            print(f"{name:<30} {result['rows']:>9,} rows {result['seconds']:8.3f}s "
+                  f"({result['rows_per_second']:,.0f} rows/s)")
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            compare_reports(json.load(file), report)
+
+if __name__ == "__main__":
+    main()
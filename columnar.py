@@ -0,0 +1,228 @@
+import argparse
+import os
+
+import database
+from migrations import migrate
+from temperature_bins import VARIABLES, bin_days, has_county_weather, weather_source
+
+# Rows fetched from SQLite and written per Arrow record batch
+BATCH_ROWS = 100_000
+
+# Hive-style partition columns of the exported dataset, giving year=2020/State=26/ directories
+PARTITION_COLUMNS = ['year', 'State']
+
+# Column name -> Arrow type name of the exported dataset, in SELECT order
+COLUMNS = {
+    'id': 'int64',
+    'St_Case': 'int64',
+    'State': 'int64',
+    'year': 'int64',
+    'day': 'int64',
+    'county_name': 'string',
+    'Fatals': 'int64',
+    'Peds': 'int64',
+    'Persons': 'int64',
+    'TotalVehicles': 'int64',
+    'has_details': 'bool_',
+    'drunk': 'int64',
+    'weekday': 'int64',
+    'intersection_type': 'string',
+    'temperature_avg': 'float64',
+    'temperature_min': 'float64',
+    'temperature_max': 'float64',
+}
+
+def require_pyarrow():
+    """Import pyarrow, which only the columnar path needs"""
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.fs
+    except ImportError:
+        raise ImportError("The columnar export and analysis need pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+def arrow_schema():
+    """Arrow schema of the exported dataset"""
+    pa = require_pyarrow()
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in COLUMNS.items()])
+
+def partitioning():
+    """Hive partitioning on PARTITION_COLUMNS with the types from the dataset schema"""
+    pa = require_pyarrow()
+    schema = arrow_schema()
+    return pa.dataset.partitioning(pa.schema([schema.field(name) for name in PARTITION_COLUMNS]),
+                                   flavor='hive')
+
+def export_sql(cursor):
+    """Build the SELECT joining crashes to their details, county and the weather of their day"""
+    # Station weather only once it covers every crash county, like the SQLite analysis
+    if has_county_weather(cursor):
+        # The crash county's own station
+        weather_join = '''
+        LEFT JOIN county_weather_stations ON county_weather_stations.county_id = crashes.county_id
+        LEFT JOIN daily_weather weather
+            ON weather.station_id = county_weather_stations.station_id AND weather.day = crashes.day'''
+    else:
+        weather_join = '''
+        LEFT JOIN daily_data_meteostat weather ON weather.day = crashes.day'''
+    return f'''
+        SELECT
+            crashes.id,
+            crashes.St_Case,
+            crashes.State,
+            crashes.year,
+            crashes.day,
+            counties.county_name,
+            crashes.Fatals,
+            crashes.Peds,
+            crashes.Persons,
+            crashes.TotalVehicles,
+            crash_details.id IS NOT NULL,
+            crash_details.drunk,
+            crash_details.weekday,
+            intersection_types.type_name,
+            weather.temperature_avg,
+            weather.temperature_min,
+            weather.temperature_max
+        FROM
+            crashes
+        LEFT JOIN counties ON counties.county_id = crashes.county_id
+        LEFT JOIN crash_details ON crash_details.id = crashes.id
+        LEFT JOIN intersection_types ON intersection_types.type_id = crash_details.type_id
+        {weather_join}
+        ORDER BY
+            crashes.id
+    '''
+
+def iter_record_batches(cursor, batch_rows=BATCH_ROWS):
+    """Yield the joined dataset as Arrow record batches of at most batch_rows rows"""
+    pa = require_pyarrow()
+    schema = arrow_schema()
+    cursor.execute(export_sql(cursor))
+    while True:
+        rows = cursor.fetchmany(batch_rows)
+        if not rows:
+            return
+        # Transpose the batch once and build each column in one call; SQLite hands back booleans as 0/1
+        columns = zip(*rows)
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(column).cast(field.type) for column, field in zip(columns, schema)], schema=schema
+        )
+
+def export_parquet(output_dir, batch_rows=BATCH_ROWS, pool=None):
+    """Write the joined crashes, details and weather to Parquet partitioned by year and state"""
+    pa = require_pyarrow()
+    pool = pool or database.get_read_pool()
+    # pyarrow pulls the batches from its own thread, which pooled connections allow
+    with pool.connection() as conn:
+        reader = pa.RecordBatchReader.from_batches(arrow_schema(), iter_record_batches(conn.cursor(), batch_rows))
+        # Batches stream from SQLite into the partition files, the dataset is never whole in memory
+        pa.dataset.write_dataset(reader, output_dir, format='parquet', partitioning=partitioning(),
+                                 existing_data_behavior='delete_matching')
+
+def open_dataset(path):
+    """Open an exported dataset with memory-mapped reads, so only the columns used are paged in"""
+    pa = require_pyarrow()
+    schema = arrow_schema()
+    return pa.dataset.dataset(
+        path, schema=schema, format='parquet',
+        partitioning=partitioning(),
+        filesystem=pa.fs.LocalFileSystem(use_mmap=True),
+    )
+
+def dataset_filter(years=None, states=None):
+    """Build a filter on the partition columns; whole directories outside it are never opened"""
+    pa = require_pyarrow()
+    condition = None
+    for column, values in (('year', years), ('State', states)):
+        if values:
+            term = pa.dataset.field(column).isin(list(values))
+            condition = term if condition is None else condition & term
+    return condition
+
+def read_columns(dataset, columns, filter=None):
+    """Read just the given columns of the rows matching filter into an Arrow table"""
+    return dataset.to_table(columns=columns, filter=filter)
+
+def group_rows(table, keys, aggregations):
+    """Group an Arrow table and return the result as sorted tuples like a SQLite GROUP BY"""
+    grouped = table.group_by(keys).aggregate(aggregations)
+    names = keys + [f'{column}_{function}' for column, function in aggregations]
+    rows = zip(*(grouped.column(name).to_pylist() for name in names))
+    # None sorts first, as NULL does in SQLite
+    return sorted(rows, key=lambda row: [(value is not None, value) for value in row[:len(keys)]])
+
+def fetch_crash_details_data(dataset, filter=None):
+    """Columnar fetch_crash_details_data: (type_name, drunk, weekday, count) per group"""
+    pa = require_pyarrow()
+    condition = pa.dataset.field('has_details')
+    table = read_columns(dataset, ['intersection_type', 'drunk', 'weekday', 'id'],
+                         condition if filter is None else condition & filter)
+    return group_rows(table, ['intersection_type', 'drunk', 'weekday'], [('id', 'count')])
+
+def fetch_drunk_fatalities_data(dataset, filter=None):
+    """Columnar fetch_drunk_fatalities_data: (drunk, crashes) per drunk driver count"""
+    pa = require_pyarrow()
+    condition = pa.dataset.field('has_details')
+    table = read_columns(dataset, ['drunk', 'id'], condition if filter is None else condition & filter)
+    return group_rows(table, ['drunk'], [('id', 'count')])
+
+def fetch_intersection_type_data(dataset, filter=None):
+    """Columnar fetch_intersection_type_data: (type_name, crashes) per intersection type"""
+    pa = require_pyarrow()
+    condition = pa.dataset.field('has_details')
+    table = read_columns(dataset, ['intersection_type', 'id'], condition if filter is None else condition & filter)
+    return group_rows(table, ['intersection_type'], [('id', 'count')])
+
+def fetch_temperature_bins_vs_fatal_crashes_data(dataset, filter=None, variable='tavg', width=10, origin=0):
+    """Columnar fetch_temperature_bins_vs_fatal_crashes_data over the days with a fatal crash
+
+    The export only has rows for crashes, so unlike the SQLite version days without a fatal
+    crash are missing. A day's temperature is the mean over its crashes' weather.
+    """
+    pa = require_pyarrow()
+    column = VARIABLES[variable]
+    condition = pa.dataset.field('Fatals') > 0
+    table = read_columns(dataset, ['day', column, 'id'], condition if filter is None else condition & filter)
+    daily = table.group_by(['day']).aggregate([(column, 'mean'), ('id', 'count')])
+    temperatures = daily.column(f'{column}_mean').to_numpy(zero_copy_only=False).astype(float)
+    return bin_days(temperatures, daily.column('id_count').to_numpy().astype(float), width, origin)
+
+# Chart name -> columnar fetch function, matching the renderers in graph.CHARTS
+COLUMNAR_CHARTS = {
+    'temperature_bins_vs_fatal_crashes': fetch_temperature_bins_vs_fatal_crashes_data,
+    'drunk_fatalities': fetch_drunk_fatalities_data,
+    'intersection_types': fetch_intersection_type_data,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Export proj_data.db to Parquet and analyze the export")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export = subparsers.add_parser('export', help="write the joined dataset partitioned by year and state")
+    export.add_argument('--output-dir', default='crashes_parquet')
+    export.add_argument('--batch-rows', type=int, default=BATCH_ROWS, help="rows per record batch")
+    analyze = subparsers.add_parser('analyze', help="print the chart data computed from an export")
+    analyze.add_argument('--dataset-dir', default='crashes_parquet')
+    analyze.add_argument('--years', type=int, nargs='+', help="only these years")
+    analyze.add_argument('--states', type=int, nargs='+', help="only these state codes")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        conn = database.get_connection()
+        migrate(conn)
+        print(weather_source(conn.cursor()))
+        export_parquet(args.output_dir, args.batch_rows)
+        database.close()
+        print(f"Exported to {os.path.abspath(args.output_dir)}")
+        return
+
+    dataset = open_dataset(args.dataset_dir)
+    filter = dataset_filter(args.years, args.states)
+    for name, fetch in COLUMNAR_CHARTS.items():
+        print(f"\n{name}:")
+        for row in fetch(dataset, filter):
+            print("   " + ", ".join(str(value) for value in row))
+
+if __name__ == "__main__":
+    main()
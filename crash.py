@@ -1,6 +1,20 @@
-import requests
-import sqlite3
+import argparse
 from datetime import datetime
+from itertools import islice
+
+import database
+import instrumentation
+import nhtsa_api
+from daily_stats import refresh_daily_crash_stats
+from dates import day_key_from_epoch
+from dimensions import county_cache
+from instrumentation import instrumented
+from ingest_state import get_state, set_state
+from migrations import migrate
+from pipeline import Checkpoint, Pipeline
+
+# Crashes inserted per executemany (and per commit in bulk mode) when streaming a response
+BATCH_SIZE = 1000
 
 def create_crashes_table(cursor):
     """Create crashes table in the database if not exists"""
@@ -8,14 +22,17 @@ def create_crashes_table(cursor):
         CREATE TABLE IF NOT EXISTS crashes (
             id INTEGER PRIMARY KEY,
             county_id INTEGER,
-            CrashDate TEXT,
+            epoch INTEGER,
+            year INTEGER,
             Fatals INTEGER,
             Peds INTEGER,
             Persons INTEGER,
             St_Case INTEGER,
             State INTEGER,
             TotalVehicles INTEGER,
-            UNIQUE(St_Case) ON CONFLICT IGNORE,
+            day INTEGER,
+            -- Case numbers restart every year and are only unique within a state
+            UNIQUE(State, St_Case, year) ON CONFLICT IGNORE,
             FOREIGN KEY (county_id) REFERENCES counties(county_id)
         )
     ''')
@@ -25,93 +42,203 @@ def create_counties_table(cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS counties (
             county_id INTEGER PRIMARY KEY,
-            county_name TEXT UNIQUE ON CONFLICT IGNORE
+            State INTEGER,
+            county_name TEXT,
+            -- County names only carry the county FIPS code, which repeats across states
+            UNIQUE(State, county_name) ON CONFLICT IGNORE
         )
     ''')
 
-def insert_county(cursor, county_name):
-    """Insert county into counties table and return its ID"""
-    cursor.execute('''
-        INSERT OR IGNORE INTO counties (county_name) VALUES (?)
-    ''', (county_name,))
-    cursor.execute('''
-        SELECT county_id FROM counties WHERE county_name = ?
-    ''', (county_name,))
-    return cursor.fetchone()[0]
-
-def insert_crash_data(cursor, entry):
-    """Insert crash data into the database"""
-    county_id = insert_county(cursor, entry["CountyName"])
-    try:
-        cursor.execute('''
-            INSERT OR IGNORE INTO crashes VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            county_id,
-            datetime.utcfromtimestamp(int(entry["CrashDate"][6:16])),
-            entry["Fatals"],
-            entry["Peds"],
-            entry["Persons"],
-            entry["St_Case"],
-            entry["State"],
-            entry["TotalVehicles"],
-        ))
-    except sqlite3.Error as e:
-        print("SQLite error:", e)
-
-def fetch_api_data(start_date, end_date):
-    """Fetch API data from NHTSA DOT API"""
-    url = "https://crashviewer.nhtsa.dot.gov/CrashAPI/crashes/GetCaseList"
+def utc_offset(crash_date):
+    """Seconds east of UTC given by a CrashDate such as /Date(1577836800000-0500)/, 0 if it has none"""
+    offset = crash_date[-7:-2]
+    if offset[0] not in '+-':
+        return 0
+    seconds = int(offset[1:3]) * 3600 + int(offset[3:]) * 60
+    return -seconds if offset[0] == '-' else seconds
+
+def case_year(entry):
+    """FARS case year of an API entry: its CaseYear, else the year of the crash in local time
+
+    CrashDate is in UTC, so its own year is the next one for a crash late on December 31.
+    """
+    if entry.get("CaseYear"):
+        return int(entry["CaseYear"])
+    epoch = int(entry["CrashDate"][6:16])
+    return datetime.utcfromtimestamp(epoch + utc_offset(entry["CrashDate"])).year
+
+def decode_crash(entry):
+    """Turn an API entry into a crashes row, still keyed by county name (the state is at index 7)"""
+    # CrashDate looks like /Date(1577836800000-0500)/, the first ten digits are epoch seconds
+    epoch = int(entry["CrashDate"][6:16])
+    return (
+        entry["CountyName"],
+        epoch,
+        case_year(entry),
+        entry["Fatals"],
+        entry["Peds"],
+        entry["Persons"],
+        entry["St_Case"],
+        entry["State"],
+        entry["TotalVehicles"],
+        day_key_from_epoch(epoch),
+    )
+
+@instrumented(rows='rows')
+def insert_crash_rows(cursor, counties, rows):
+    """Insert a batch of decoded crash rows into the database"""
+    # Resolve every county in the batch up front so the insert is a single executemany
+    counties.resolve((row[7], row[0]) for row in rows)
+    # Errors propagate so the caller's transaction, checkpoint included, is never committed half done
+    cursor.executemany('''
+        INSERT OR IGNORE INTO crashes
+            (county_id, epoch, year, Fatals, Peds, Persons, St_Case, State, TotalVehicles, day)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(counties.get_id((row[7], row[0])), *row[1:]) for row in rows])
+    # Keep the per-day aggregates in step with the rows just written
+    refresh_daily_crash_stats(cursor, (row[-1] for row in rows))
+
+@instrumented(rows='entries')
+def insert_crash_data(cursor, counties, entries):
+    """Insert a batch of crash entries into the database"""
+    insert_crash_rows(cursor, counties, [decode_crash(entry) for entry in entries])
+
+def case_list_request(start_date, end_date, state=26, min_vehicles=1, max_vehicles=6):
+    """Build the GetCaseList URL and parameters"""
+    url = nhtsa_api.API_URL + "/crashes/GetCaseList"
     params = {
-        "states": "26",  # Change the state code to Michigan's code
+        "states": str(state),  # 26 is Michigan's code
         "fromYear": start_date.year,
         "toYear": end_date.year,
-        "minNumOfVehicles": "1",
-        "maxNumOfVehicles": "6",
+        "minNumOfVehicles": str(min_vehicles),
+        "maxNumOfVehicles": str(max_vehicles),
         "format": "json",
     }
-
-    # Make the API request
-    response = requests.get(url, params=params)
-    return response.json()["Results"]
-
-def update_start_index(end_index):
-    """Update the start index in the file"""
-    with open('start_index.txt', 'w') as file:
-        file.write(str(end_index))
-
-def fetch_and_insert_crashes(cursor, start_date, end_date):
+    return url, params
+
+def iter_case_list(url, params):
+    """Yield the cases of a GetCaseList request, giving each the CaseYear of a single-year request"""
+    year = params["fromYear"] if params["fromYear"] == params["toYear"] else None
+    for entry in nhtsa_api.iter_results(url, params):
+        if year is not None:
+            entry.setdefault("CaseYear", year)
+        yield entry
+
+def iter_api_data(start_date, end_date, state=26, min_vehicles=1, max_vehicles=6):
+    """Yield the cases from NHTSA DOT API one at a time without holding the whole response"""
+    url, params = case_list_request(start_date, end_date, state, min_vehicles, max_vehicles)
+    return iter_case_list(url, params)
+
+def insert_crash_stream(cursor, counties, cases, batch_size=BATCH_SIZE):
+    """Insert crash entries from an iterator in batches, returning how many were read"""
+    total = 0
+    batch = []
+    for entry in cases:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            insert_crash_data(cursor, counties, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        insert_crash_data(cursor, counties, batch)
+        total += len(batch)
+    return total
+
+def fetch_and_insert_crashes(conn, cursor, start_date, end_date):
     """Fetch and insert crashes data into the database"""
-    start_index = int(open('start_index.txt', 'r').read().strip())
-    api_data = fetch_api_data(start_date, end_date)
-    end_index = start_index + 25
+    start_index = int(get_state(cursor, 'crashes', 0))
+    # Only the next 25 cases are kept from the streamed response
+    cases = list(islice(iter_api_data(start_date, end_date), start_index, start_index + 25))
+    end_index = start_index + len(cases)
 
-    if end_index >= len(api_data[0]):
+    if not cases:
         print("Done fetching data for this time period")
         return
     # INSERTS THE NEXT 25
-    for entry in api_data[0][start_index:end_index]:
-        insert_crash_data(cursor, entry)
-
-    update_start_index(end_index)
+    insert_crash_data(cursor, county_cache(cursor), cases)
+
+    # The offset is committed with the rows, so a failure never skips or repeats any
+    set_state(cursor, 'crashes', end_index)
+    with instrumentation.span('sqlite.commit'):
+        conn.commit()
+
+def bulk_year_key(year):
+    """ingest_state pipeline name recording that bulk mode loaded a whole year"""
+    return f'crashes_bulk:{year}'
+
+def iter_bulk_cases(years):
+    """Yield every case of each year, followed by a checkpoint once the year is complete"""
+    for year in years:
+        # One request per year, streamed a case at a time
+        yield from iter_api_data(datetime(year, 1, 1), datetime(year, 12, 31))
+        yield Checkpoint(bulk_year_key(year), year)
+
+def fetch_and_insert_crashes_bulk(conn, cursor, start_year, end_year, resume=False,
+                                  batch_size=BATCH_SIZE, report_every=None):
+    """Fetch every crash for each year in the range through a fetch -> decode -> write pipeline
+
+    The writer commits every batch_size rows; a year's checkpoint is committed once all of its rows are.
+    With resume, exactly the years that already have a checkpoint are skipped.
+    """
+    years = range(start_year, end_year + 1)
+    if resume:
+        years = [year for year in years if get_state(cursor, bulk_year_key(year)) is None]
+
+    counties = county_cache(cursor)
+
+    def write(rows, checkpoint):
+        insert_crash_rows(cursor, counties, rows)
+        if checkpoint is not None:
+            set_state(cursor, checkpoint.pipeline, checkpoint.position)
+            print(f"Finished crashes for {checkpoint.position}")
+        with instrumentation.span('sqlite.commit'):
+            conn.commit()
+
+    ingest = Pipeline(iter_bulk_cases(years), [('decode', decode_crash)], write, batch_size)
+    ingest.run(report_every)
+    print(ingest.report())
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Load NHTSA crashes into proj_data.db")
+    parser.add_argument('--bulk', action='store_true',
+                        help="load every crash for the given years instead of the next 25")
+    parser.add_argument('--start-year', type=int, default=2020)
+    parser.add_argument('--end-year', type=int, default=2021)
+    parser.add_argument('--resume', action='store_true',
+                        help="with --bulk, skip the years a previous run already committed")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="with --bulk, rows per commit")
+    parser.add_argument('--report-every', type=float,
+                        help="with --bulk, print pipeline stats every this many seconds")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.setup(args)
+
+    # SQLite database connection
+    conn = database.get_connection()
+    cursor = conn.cursor()
+
+    # Create counties table in the database if not exists
+    create_counties_table(cursor)
+
+    # Create crashes table in the database if not exists
+    create_crashes_table(cursor)
     conn.commit()
+    migrate(conn)
 
-# SQLite database connection
-conn = sqlite3.connect('proj_data.db')
-cursor = conn.cursor()
-
-# Create counties table in the database if not exists
-create_counties_table(cursor)
-
-# Create crashes table in the database if not exists
-create_crashes_table(cursor)
-conn.commit()
+    if args.bulk:
+        # Fetch and insert every record for Michigan, one year at a time
+        fetch_and_insert_crashes_bulk(conn, cursor, args.start_year, args.end_year, args.resume,
+                                      args.batch_size, args.report_every)
+    else:
+        # Set the time period for the entire timeframe
+        start_date_initial = datetime(args.start_year, 1, 1)
+        end_date_initial = datetime(args.end_year, 1, 1)
 
-# Set the time period for the entire timeframe
-start_date_initial = datetime(2020, 1, 1)
-end_date_initial = datetime(2021, 1, 1)
+        # Fetch and insert the next 25 records for Michigan
+        fetch_and_insert_crashes(conn, cursor, start_date_initial, end_date_initial)
 
-# Fetch and insert the next 25 records for Michigan
-fetch_and_insert_crashes(cursor, start_date_initial, end_date_initial)
+    # Close the database connection
+    database.close()
 
-# Close the database connection
-conn.close()
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,28 @@
-import requests
-import sqlite3
+import argparse
+import threading
+import time
+
+import database
+import instrumentation
+import nhtsa_api
+from daily_stats import refresh_daily_crash_stats_for_crashes
+from dimensions import intersection_type_cache
+from ingest_state import bump_version, get_state, set_state
+from instrumentation import instrumented
+from migrations import column_exists, migrate
+from payloads import (PAGE_SIZE, compress_payload, create_case_payloads_table, iter_stored_details,
+                      store_payloads)
+from pipeline import Pipeline
+
+BASE_URL = nhtsa_api.API_URL + "/crashes/GetCaseDetails"
+
+# Extra crash_details columns -> (SQL type, CrashResultSet field). A column added here is
+# created by add_detail_columns and filled for past crashes by --backfill from the stored payloads.
+DETAIL_FIELDS = {
+    'light_condition': ('TEXT', 'LGT_CONDNAME'),
+    'weather': ('TEXT', 'WEATHERNAME'),
+    'vehicles': ('INTEGER', 'VE_TOTAL'),
+}
 
 def create_crash_details_table(cursor):
     """Create crash_details table in the database if not exists"""
@@ -24,9 +47,38 @@ def create_intersection_types_table(cursor):
         )
     ''')
 
-def get_case_details(state_case, case_year, state):
-    """Fetch case details from NHTSA DOT API"""
-    base_url = "https://crashviewer.nhtsa.dot.gov/CrashAPI/crashes/GetCaseDetails"
+def add_detail_columns(cursor):
+    """Add every DETAIL_FIELDS column crash_details does not have yet"""
+    for column, (sql_type, _) in DETAIL_FIELDS.items():
+        if not column_exists(cursor, 'crash_details', column):
+            cursor.execute(f"ALTER TABLE crash_details ADD COLUMN {column} {sql_type}")
+
+class TokenBucket:
+    """Token bucket rate limiter shared by the fetch workers"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+@instrumented()
+def get_case_details(state_case, case_year, state, base_url=BASE_URL, retries=3, backoff=1.0):
+    """Fetch case details from NHTSA DOT API, raising NHTSAError if the request failed"""
     params = {
         "stateCase": state_case,
         "caseYear": case_year,
@@ -34,81 +86,191 @@ def get_case_details(state_case, case_year, state):
         "format": "json"
     }
 
-    response = requests.get(base_url, params=params)
+    case_details = nhtsa_api.get_json(base_url, params, retries=retries, backoff=backoff)
+    # A failed request is not a missing case; it must not be skipped or checkpointed past
+    if case_details is None:
+        raise nhtsa_api.NHTSAError(f"Could not fetch details of case {state_case} ({case_year}, state {state})")
+    return case_details
 
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Error: {response.status_code}")
+def crash_result_set(case_details):
+    """Return the CrashResultSet of a GetCaseDetails response, or None if the case was not found"""
+    # Only empty Results mean the case does not exist; a malformed response raises
+    try:
+        results = case_details["Results"][0][0]
+    except IndexError:
+        return None
+
+    if results is None:
         return None
+    return results['CrashResultSet']
 
-def fetch_and_insert_crash_details(cursor, start_id):
+def extract_crash_details(case_details):
+    """Pull drunk count, intersection type, weekday and the DETAIL_FIELDS out of a GetCaseDetails response"""
+    crash = crash_result_set(case_details)
+    if crash is None:
+        return None
+    # 1 = Monday, 7 = Sunday
+    return (crash['DRUNK_DR'], crash['TYP_INTNAME'], crash['DAY_WEEK'],
+            *(crash.get(field) for _, field in DETAIL_FIELDS.values()))
+
+def fetch_and_insert_crash_details(conn, cursor, start_id, base_url=BASE_URL):
     """Fetch and insert crash details into the database"""
     # Make the API request with parameters for the next 25 crashes
     end_id = start_id + 25
+    batch = []
+    payloads = []
     for id in range(start_id, end_id):
-        cursor.execute("SELECT ST_Case, State, CrashDate FROM crashes WHERE id = ?", (id,))
+        cursor.execute("SELECT ST_Case, State, year FROM crashes WHERE id = ?", (id,))
         data = cursor.fetchone()
 
         if data is not None:
-            st_case, state_code, date = data
-            year = date.split('-')[0]
-            case_details = get_case_details(st_case, year, state_code)
+            st_case, state_code, year = data
+            case_details = get_case_details(st_case, year, state_code, base_url=base_url)
 
-            try:
-                results = case_details["Results"][0][0]
-            except IndexError:
+            details = extract_crash_details(case_details)
+            if details is None:
                 print(f"Case id {id} not found")
                 continue
 
-            if results is not None:
-                drunk = results['CrashResultSet']['DRUNK_DR']
-                intersection_type = results['CrashResultSet']['TYP_INTNAME']
-                # 1 = Monday, 7 = Sunday
-                weekDay = results['CrashResultSet']['DAY_WEEK']
+            batch.append((id, details))
+            payloads.append((st_case, year, state_code, compress_payload(case_details)))
+
+    # Insert crash_details with their type_id in one go, committing the next id with them
+    store_payloads(cursor, payloads)
+    write_crash_details_batch(cursor, intersection_type_cache(cursor), batch)
+    set_state(cursor, 'crash_details', end_id)
+    conn.commit()
+
 
-                # Check if intersection_type exists in intersection_types table
-                cursor.execute('''
-                    SELECT type_id FROM intersection_types WHERE type_name = ?
-                ''', (intersection_type,))
+def fetch_crash_details_worker(bucket, crash, base_url, retries, backoff):
+    """Fetch the raw details for one crash, respecting the rate limit"""
+    id, st_case, state_code, year = crash
+    bucket.acquire()
+    case_details = get_case_details(st_case, year, state_code,
+                                    base_url=base_url, retries=retries, backoff=backoff)
+    return crash, case_details
 
-                result = cursor.fetchone()
+def extract_crash_details_item(item):
+    """Pipeline step: turn a fetched (crash, response) into (id, details, payload row), dropping cases not found"""
+    (id, st_case, state_code, year), case_details = item
+    details = extract_crash_details(case_details)
+    if details is None:
+        print(f"Case id {id} not found")
+        return None
+    # Compressing here keeps the work off the writer thread
+    return id, details, (st_case, year, state_code, compress_payload(case_details))
 
-                if result is not None:
-                    type_id = result[0]
-                else:
-                    # Insert new intersection_type and get its ID
-                    cursor.execute('''
-                        INSERT INTO intersection_types (type_name) VALUES (?)
-                    ''', (intersection_type,))
+@instrumented(rows='batch')
+def write_crash_details_batch(cursor, intersection_types, batch):
+    """Insert a batch of fetched crash details; the caller commits"""
+    intersection_types.resolve(details[1] for _, details in batch)
+    rows = [
+        (id, drunk, weekDay, intersection_types.get_id(intersection_type), *extra)
+        for id, (drunk, intersection_type, weekDay, *extra) in batch
+    ]
+    columns = ', '.join(['id', 'drunk', 'weekday', 'type_id', *DETAIL_FIELDS])
+    placeholders = ', '.join('?' * (4 + len(DETAIL_FIELDS)))
+    cursor.executemany(f'INSERT OR IGNORE INTO crash_details ({columns}) VALUES ({placeholders})', rows)
+    # Drunk counts in daily_crash_stats depend on the details just written
+    refresh_daily_crash_stats_for_crashes(cursor, (row[0] for row in rows))
 
-                    type_id = cursor.lastrowid
+def fetch_and_insert_crash_details_concurrent(conn, cursor, max_workers=8, rate=10.0,
+                                              batch_size=100, base_url=BASE_URL,
+                                              retries=3, backoff=1.0, report_every=None):
+    """Fetch details for every crash without them through a fetch -> extract -> write pipeline
 
-                # Insert crash_detail with type_id
-                cursor.execute('''
-                    INSERT OR IGNORE INTO crash_details (id, drunk, weekday, type_id) VALUES (?, ?, ?, ?)
-                ''', (id, drunk, weekDay, type_id))
+    Requests run on max_workers threads and only this thread writes. The crashes still
+    missing details are the checkpoint, so a rerun resumes where the last one stopped.
+    """
+    cursor.execute('''
+        SELECT crashes.id, crashes.St_Case, crashes.State, crashes.year
+        FROM crashes
+        LEFT JOIN crash_details ON crash_details.id = crashes.id
+        WHERE crash_details.id IS NULL
+        ORDER BY crashes.id
+    ''')
+    pending_crashes = cursor.fetchall()
 
-    with open('details_index.txt', 'w') as file:
-        file.write(str(end_id))
-    conn.commit()
+    bucket = TokenBucket(rate)
+    intersection_types = intersection_type_cache(cursor)
+
+    def fetch(crash):
+        return fetch_crash_details_worker(bucket, crash, base_url, retries, backoff)
+
+    def write(batch, checkpoint):
+        store_payloads(cursor, [payload for _, _, payload in batch])
+        write_crash_details_batch(cursor, intersection_types, [(id, details) for id, details, _ in batch])
+        with instrumentation.span('sqlite.commit'):
+            conn.commit()
 
+    # Queues hold a couple of requests per worker so memory stays bounded
+    ingest = Pipeline(pending_crashes, [('fetch', fetch, max_workers), ('extract', extract_crash_details_item)],
+                      write, batch_size, queue_size=max_workers * 2)
+    stats = ingest.run(report_every)
+    print(ingest.report())
+    print(f"Inserted details for {stats['write']['items']} crashes")
 
-# SQLite database connection
-conn = sqlite3.connect('proj_data.db')
-cursor = conn.cursor()
+def backfill_crash_details(conn, cursor, columns=None, page_size=PAGE_SIZE):
+    """Fill DETAIL_FIELDS columns of crash_details from the stored payloads, without any requests"""
+    columns = columns or list(DETAIL_FIELDS)
+    assignments = ', '.join(f'{column} = ?' for column in columns)
+    filled = 0
+    for page in iter_stored_details(cursor, page_size):
+        rows = []
+        for id, case_details in page:
+            crash = crash_result_set(case_details)
+            if crash is not None:
+                rows.append((*(crash.get(DETAIL_FIELDS[column][1]) for column in columns), id))
+        cursor.executemany(f'UPDATE crash_details SET {assignments} WHERE id = ?', rows)
+        bump_version(cursor, 'crash_details')
+        conn.commit()
+        filled += len(rows)
+    return filled
 
-# Create crash_details table in the database if it doesn't exists
-create_crash_details_table(cursor)
-conn.commit()
-create_intersection_types_table(cursor)
-conn.commit()
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Load NHTSA crash details into proj_data.db")
+    parser.add_argument('--concurrent', action='store_true',
+                        help="fetch details for every crash without them instead of the next 25")
+    parser.add_argument('--workers', type=int, default=8, help="maximum concurrent requests")
+    parser.add_argument('--rate', type=float, default=10.0, help="maximum requests per second")
+    parser.add_argument('--batch-size', type=int, default=100, help="rows per commit")
+    parser.add_argument('--base-url', default=BASE_URL, help="GetCaseDetails endpoint")
+    parser.add_argument('--backfill', nargs='*', choices=list(DETAIL_FIELDS), metavar='COLUMN',
+                        help="fill these columns (all of them if none are given) from the stored payloads")
+    parser.add_argument('--report-every', type=float,
+                        help="with --concurrent, print pipeline stats every this many seconds")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.setup(args)
 
-# Read the start index from the file
-with open('details_index.txt', 'r') as file:
-    start_index = int(file.read().strip())
+    # SQLite database connection
+    conn = database.get_connection()
+    cursor = conn.cursor()
+
+    # Create crash_details table in the database if it doesn't exists
+    create_crash_details_table(cursor)
+    conn.commit()
+    create_intersection_types_table(cursor)
+    create_case_payloads_table(cursor)
+    add_detail_columns(cursor)
+    conn.commit()
+    migrate(conn)
+
+    if args.backfill is not None:
+        filled = backfill_crash_details(conn, cursor, args.backfill)
+        print(f"Backfilled {filled} crashes from stored payloads")
+    elif args.concurrent:
+        fetch_and_insert_crash_details_concurrent(conn, cursor, args.workers, args.rate,
+                                                  args.batch_size, args.base_url,
+                                                  report_every=args.report_every)
+    else:
+        # Read the start index saved by the last run
+        start_index = int(get_state(cursor, 'crash_details', 1))
+
+        # Fetch and insert the next 25 crash details
+        fetch_and_insert_crash_details(conn, cursor, start_index, args.base_url)
+    conn.commit()
+    database.close()
 
-# Fetch and insert the next 25 crash details
-fetch_and_insert_crash_details(cursor, start_index)
-conn.commit()
-conn.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import importlib
+import os
+import sys
+
+import database
+from dates import date_from_day_key
+from migrations import column_exists, table_exists
+
+# Subcommand -> (module whose main() runs it, description). Modules are imported only
+# when their subcommand runs, so pandas, meteostat, requests and matplotlib are never
+# loaded for a command that does not use them.
+COMMANDS = {
+    'ingest-crashes': ('crash', "load NHTSA crashes"),
+    'ingest-details': ('crash_details', "load NHTSA crash details"),
+    'ingest-weather': ('weather', "load Meteostat daily weather"),
+    'report': ('report', "write calcs.txt and calcs.json"),
+    'charts': ('graph', "analyze the database and draw the charts"),
+    'status': (None, "show what has been loaded, without touching the network"),
+}
+
+# Tables reported by status, in load order
+STATUS_TABLES = ['counties', 'crashes', 'crash_details', 'case_payloads', 'daily_data_meteostat', 'daily_weather']
+
+def file_size(path):
+    """Size of a file in MiB, or 0 if it does not exist"""
+    try:
+        return os.path.getsize(path) / (1024 * 1024)
+    except OSError:
+        return 0
+
+def day_span(cursor, table):
+    """'first to last' day of a table with a day column, or None if it is empty"""
+    if not table_exists(cursor, table):
+        return None
+    # Status never migrates, and tables from before the day keys do not have the column yet
+    if not column_exists(cursor, table, 'day'):
+        return 'not migrated (run any other command first)'
+    # MIN and MAX of an indexed column are single index lookups
+    cursor.execute(f'SELECT MIN(day), MAX(day) FROM {table}')
+    first, last = cursor.fetchone()
+    if first is None:
+        return None
+    return f'{date_from_day_key(first)} to {date_from_day_key(last)}'
+
+def status(path=database.DB_PATH):
+    """Print table sizes, loaded date ranges and ingest checkpoints of the database"""
+    if not os.path.exists(path):
+        print(f"{path} does not exist yet; run an ingest command first")
+        return 1
+    print(f"{path}: {file_size(path):.1f} MiB, WAL {file_size(path + '-wal'):.1f} MiB")
+
+    # Read-only, so status never waits on or blocks an ingest in progress
+    conn = database.connect(path, readonly=True)
+    cursor = conn.cursor()
+
+    print("\nRows:")
+    counts = {}
+    for table in STATUS_TABLES:
+        if table_exists(cursor, table):
+            cursor.execute(f'SELECT COUNT(*) FROM {table}')
+            counts[table] = cursor.fetchone()[0]
+            print(f"   {table:<22} {counts[table]:>10}")
+    if 'crashes' in counts and 'crash_details' in counts:
+        print(f"   {'awaiting details':<22} {counts['crashes'] - counts['crash_details']:>10}")
+
+    print("\nDays loaded:")
+    for table, label in [('crashes', 'crashes'), ('daily_data_meteostat', 'Detroit weather'),
+                         ('daily_weather', 'station weather')]:
+        print(f"   {label:<22} {day_span(cursor, table) or 'none'}")
+
+    if table_exists(cursor, 'ingest_state'):
+        cursor.execute('SELECT pipeline, position, updated_at FROM ingest_state ORDER BY pipeline')
+        rows = cursor.fetchall()
+        if rows:
+            print("\nIngest checkpoints:")
+            for pipeline, position, updated_at in rows:
+                print(f"   {pipeline:<22} {position:>10}   {updated_at or ''}")
+    conn.close()
+    return 0
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(
+        prog='crashdb', description="Crash and weather database commands",
+        epilog="\n".join(f"  {name:<16} {description}" for name, (_, description) in COMMANDS.items())
+               + "\n\nRun 'crashdb COMMAND --help' for the options of a command.",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=list(COMMANDS), metavar='COMMAND')
+    # Only the command is parsed here; its options go to the module that runs it
+    args = parser.parse_args(argv[:1])
+
+    module_name, _ = COMMANDS[args.command]
+    if module_name is None:
+        status_parser = argparse.ArgumentParser(prog='crashdb status', description=COMMANDS['status'][1])
+        status_parser.add_argument('--db', default=database.DB_PATH, help="database file")
+        return status(status_parser.parse_args(argv[1:]).db)
+    module = importlib.import_module(module_name)
+    return module.main(argv[1:], prog=f'crashdb {args.command}')
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import argparse
+
+import database
+from dimensions import CHUNK_SIZE
+from ingest_state import bump_version
+
+def create_daily_crash_stats_table(cursor):
+    """Create daily_crash_stats table in the database if not exists"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_crash_stats (
+            day INTEGER,
+            county_id INTEGER,
+            crashes INTEGER,
+            fatal_crashes INTEGER,
+            fatals INTEGER,
+            persons INTEGER,
+            peds INTEGER,
+            vehicles INTEGER,
+            drunk_crashes INTEGER,
+            PRIMARY KEY (day, county_id),
+            FOREIGN KEY (county_id) REFERENCES counties(county_id)
+        )
+    ''')
+
+def aggregate_sql(cursor, where=''):
+    """Build the SELECT that aggregates crashes into daily_crash_stats rows"""
+    # crash_details may not have been created yet on a fresh database
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'crash_details'")
+    if cursor.fetchone() is not None:
+        drunk_join = 'LEFT JOIN crash_details ON crash_details.id = crashes.id'
+        drunk_sum = 'COALESCE(SUM(crash_details.drunk > 0), 0)'
+    else:
+        drunk_join = ''
+        drunk_sum = '0'
+    return f'''
+        SELECT
+            crashes.day,
+            crashes.county_id,
+            COUNT(crashes.id),
+            SUM(crashes.Fatals > 0),
+            SUM(crashes.Fatals),
+            SUM(crashes.Persons),
+            SUM(crashes.Peds),
+            SUM(crashes.TotalVehicles),
+            {drunk_sum}
+        FROM
+            crashes
+        {drunk_join}
+        {where}
+        GROUP BY
+            crashes.day, crashes.county_id
+    '''
+
+def refresh_daily_crash_stats(cursor, days):
+    """Recompute the daily_crash_stats rows for the given day keys"""
+    days = sorted(set(days))
+    for start in range(0, len(days), CHUNK_SIZE):
+        chunk = days[start:start + CHUNK_SIZE]
+        placeholders = ', '.join('?' * len(chunk))
+        cursor.execute(f'DELETE FROM daily_crash_stats WHERE day IN ({placeholders})', chunk)
+        cursor.execute(
+            'INSERT INTO daily_crash_stats ' + aggregate_sql(cursor, f'WHERE crashes.day IN ({placeholders})'),
+            chunk
+        )
+    bump_version(cursor, 'daily_crash_stats')
+
+def refresh_daily_crash_stats_for_crashes(cursor, crash_ids):
+    """Recompute the daily_crash_stats rows for the days the given crashes fall on"""
+    crash_ids = list(crash_ids)
+    days = set()
+    for start in range(0, len(crash_ids), CHUNK_SIZE):
+        chunk = crash_ids[start:start + CHUNK_SIZE]
+        placeholders = ', '.join('?' * len(chunk))
+        cursor.execute(f'SELECT DISTINCT day FROM crashes WHERE id IN ({placeholders})', chunk)
+        days.update(row[0] for row in cursor.fetchall())
+    refresh_daily_crash_stats(cursor, days)
+
+def rebuild_daily_crash_stats(cursor):
+    """Recompute daily_crash_stats from scratch"""
+    cursor.execute('DELETE FROM daily_crash_stats')
+    cursor.execute('INSERT INTO daily_crash_stats ' + aggregate_sql(cursor))
+    bump_version(cursor, 'daily_crash_stats')
+
+def check_daily_crash_stats(cursor):
+    """Return the (day, county_id) keys where daily_crash_stats disagrees with crashes"""
+    fresh = aggregate_sql(cursor)
+    cursor.execute(f'''
+        SELECT day, county_id FROM (SELECT * FROM daily_crash_stats EXCEPT {fresh})
+        UNION
+        SELECT day, county_id FROM ({fresh} EXCEPT SELECT * FROM daily_crash_stats)
+        ORDER BY day, county_id
+    ''')
+    return cursor.fetchall()
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the daily_crash_stats aggregate table")
+    parser.add_argument('--rebuild', action='store_true', help="recompute the whole table from crashes")
+    args = parser.parse_args()
+
+    # migrations imports this module, so it is imported here rather than at the top
+    from migrations import migrate
+
+    conn = database.get_connection()
+    cursor = conn.cursor()
+    # Creating the table directly would leave it empty, as the migration only fills a table it creates
+    migrate(conn)
+
+    if args.rebuild:
+        rebuild_daily_crash_stats(cursor)
+        conn.commit()
+        print("Rebuilt daily_crash_stats")
+
+    mismatches = check_daily_crash_stats(cursor)
+    if mismatches:
+        print(f"daily_crash_stats is out of date for {len(mismatches)} day/county rows, run with --rebuild")
+    else:
+        print("daily_crash_stats is consistent with crashes")
+    database.close()
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
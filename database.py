@@ -0,0 +1,114 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_PATH = 'proj_data.db'
+
+# Applied to every connection. WAL lets readers run while an ingest script writes, and
+# synchronous=NORMAL is safe under WAL: a power cut can lose the last commits, never corrupt.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64 * 1024,  # Negative means KiB, so 64 MiB of page cache
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# Seconds a connection waits on another writer's lock before raising "database is locked"
+BUSY_TIMEOUT = 30.0
+
+_connection = None
+_connection_pid = None
+_read_pools = {}
+_lock = threading.Lock()
+
+def apply_pragmas(conn, readonly=False):
+    """Apply the performance pragmas to a connection"""
+    for name, value in PRAGMAS.items():
+        # A read-only connection cannot switch the journal mode, it follows the file
+        if readonly and name == 'journal_mode':
+            continue
+        conn.execute(f"PRAGMA {name} = {value}")
+
+def connect(path=DB_PATH, readonly=False, check_same_thread=True):
+    """Open a new tuned connection to the database"""
+    if readonly:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=BUSY_TIMEOUT,
+                               check_same_thread=check_same_thread)
+    else:
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread)
+    apply_pragmas(conn, readonly)
+    return conn
+
+def get_connection(path=DB_PATH):
+    """Return the process's read-write connection, opening it on first use
+
+    A child process started with fork gets its own connection instead of sharing its parent's.
+    """
+    global _connection, _connection_pid
+    with _lock:
+        if _connection is None or _connection_pid != os.getpid():
+            _connection = connect(path)
+            _connection_pid = os.getpid()
+        return _connection
+
+def close():
+    """Close the process's read-write connection and every pooled reader"""
+    global _connection
+    with _lock:
+        if _connection is not None and _connection_pid == os.getpid():
+            _connection.close()
+        _connection = None
+        pools = list(_read_pools.values())
+        _read_pools.clear()
+    for pool in pools:
+        pool.close()
+
+class ReadPool:
+    """Fixed-size pool of read-only connections for the analysis side"""
+
+    def __init__(self, path=DB_PATH, size=4):
+        self.path = path
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a read-only connection, blocking while all of them are in use"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def acquire(self):
+        """Take an idle connection, opening a new one while the pool is below its size"""
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.opened < self.size:
+                self.opened += 1
+                # Connections move between threads with the pool, never used by two at once
+                return connect(self.path, readonly=True, check_same_thread=False)
+        return self.idle.get()
+
+    def close(self):
+        """Close every idle connection in the pool"""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+def get_read_pool(path=DB_PATH, size=4):
+    """Return the shared read-only pool for a database file"""
+    with _lock:
+        if path not in _read_pools:
+            _read_pools[path] = ReadPool(path, size)
+        return _read_pools[path]
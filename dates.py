@@ -0,0 +1,16 @@
+from datetime import date
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+SECONDS_PER_DAY = 24 * 60 * 60
+
+def day_key(value):
+    """Return the day key (days since 1970-01-01) for a date or datetime"""
+    return value.toordinal() - EPOCH_ORDINAL
+
+def day_key_from_epoch(seconds):
+    """Return the day key for a UTC epoch timestamp in seconds"""
+    return seconds // SECONDS_PER_DAY
+
+def date_from_day_key(day):
+    """Return the date of a day key"""
+    return date.fromordinal(day + EPOCH_ORDINAL)
@@ -0,0 +1,94 @@
+# Values bound per IN (...) statement, to stay well under SQLite's bound parameter limit
+CHUNK_SIZE = 500
+
+class DimensionCache:
+    """In-memory name -> id map for a lookup table such as counties or intersection_types
+
+    name_column may be a tuple of columns, in which case names are tuples of their values.
+    """
+
+    def __init__(self, cursor, table, id_column, name_column):
+        self.cursor = cursor
+        self.table = table
+        self.id_column = id_column
+        self.name_column = name_column
+        self.name_columns = name_column if isinstance(name_column, tuple) else (name_column,)
+        self.ids = {}
+        self.preload()
+
+    def preload(self):
+        """Load every existing name and id from the table"""
+        # Rows with a NULL name can repeat; descending order leaves the first of them in the map
+        self.cursor.execute(f'''
+            SELECT {", ".join(self.name_columns)}, {self.id_column} FROM {self.table}
+            ORDER BY {self.id_column} DESC
+        ''')
+        self.ids = dict(self.keyed(self.cursor.fetchall()))
+
+    def values(self, name):
+        """Column values of a name"""
+        return name if isinstance(self.name_column, tuple) else (name,)
+
+    def keyed(self, rows):
+        """Turn (name columns..., id) rows into (name, id) pairs"""
+        if not isinstance(self.name_column, tuple):
+            return rows
+        return ((tuple(row[:-1]), row[-1]) for row in rows)
+
+    def resolve_null(self, name):
+        """Return the id of a name with a NULL column, inserting it only if no row has it yet"""
+        values = self.values(name)
+        conditions = ' AND '.join(f'{column} IS ?' for column in self.name_columns)
+        self.cursor.execute(f'''
+            SELECT {self.id_column} FROM {self.table} WHERE {conditions} ORDER BY {self.id_column} LIMIT 1
+        ''', values)
+        row = self.cursor.fetchone()
+        if row is not None:
+            return row[0]
+        placeholders = ', '.join('?' * len(values))
+        self.cursor.execute(f'INSERT INTO {self.table} ({", ".join(self.name_columns)}) VALUES ({placeholders})',
+                            values)
+        return self.cursor.lastrowid
+
+    def resolve(self, names):
+        """Make sure every name has an id, inserting the new ones in one batch"""
+        # First-seen order, as a NULL name cannot be sorted with the others
+        missing = list(dict.fromkeys(name for name in names if name not in self.ids))
+        # Neither UNIQUE nor IN (VALUES ...) ever matches NULL, so those names are looked up with IS
+        for name in missing:
+            if None in self.values(name):
+                self.ids[name] = self.resolve_null(name)
+        missing = [name for name in missing if None not in self.values(name)]
+        if not missing:
+            return
+        columns = ', '.join(self.name_columns)
+        row_placeholder = '(' + ', '.join('?' * len(self.name_columns)) + ')'
+        self.cursor.executemany(
+            f'INSERT OR IGNORE INTO {self.table} ({columns}) VALUES {row_placeholder}',
+            [self.values(name) for name in missing]
+        )
+        for start in range(0, len(missing), CHUNK_SIZE):
+            chunk = missing[start:start + CHUNK_SIZE]
+            placeholders = ', '.join([row_placeholder] * len(chunk))
+            self.cursor.execute(f'''
+                SELECT {columns}, {self.id_column} FROM {self.table}
+                WHERE ({columns}) IN (VALUES {placeholders})
+            ''', [value for name in chunk for value in self.values(name)])
+            self.ids.update(self.keyed(self.cursor.fetchall()))
+
+    def get_id(self, name):
+        """Return the id for a name, inserting it if it is new"""
+        if name not in self.ids:
+            self.resolve([name])
+        return self.ids[name]
+
+def county_cache(cursor):
+    """Dimension cache for the counties table, keyed by (State, county_name)
+
+    NHTSA county names only carry the county FIPS code, which repeats across states.
+    """
+    return DimensionCache(cursor, 'counties', 'county_id', ('State', 'county_name'))
+
+def intersection_type_cache(cursor):
+    """Dimension cache for the intersection_types table"""
+    return DimensionCache(cursor, 'intersection_types', 'type_id', 'type_name')
@@ -1,35 +1,53 @@
-import sqlite3
-import matplotlib.pyplot as plt
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# matplotlib is imported inside the chart functions, so fetching chart data for
+# report.py or crashdb.py does not pay for loading it
 import numpy as np
 
-def fetch_temperature_vs_crashes_data():
-    """Fetch data for Temperature vs Number of Crashes analysis"""
-    conn = sqlite3.connect('proj_data.db')
-    cursor = conn.cursor()
+import database
+import instrumentation
+from instrumentation import instrumented
+from migrations import migrate
+from temperature_bins import bin_days, fetch_daily_fatal_crashes, weather_source
+
+def show_or_save(output_path):
+    """Show the current figure, or write it to output_path and close it when rendering headless"""
+    import matplotlib.pyplot as plt
+
+    if output_path is None:
+        plt.show()
+    else:
+        plt.savefig(output_path)
+        plt.close()
 
+@instrumented(rows='result')
+def fetch_temperature_vs_crashes_data(cursor):
+    """Fetch data for Temperature vs Number of Crashes analysis"""
     cursor.execute('''
         SELECT
             daily_data_meteostat.date,
             daily_data_meteostat.temperature_avg,
-            COUNT(crashes.id) as num_crashes
+            COALESCE(SUM(daily_crash_stats.crashes), 0) as num_crashes
         FROM
             daily_data_meteostat
         LEFT JOIN
-            crashes
+            daily_crash_stats
         ON
-            strftime('%Y-%m-%d', daily_data_meteostat.date) = strftime('%Y-%m-%d', crashes.CrashDate)
+            daily_data_meteostat.day = daily_crash_stats.day
         GROUP BY
             daily_data_meteostat.date, daily_data_meteostat.temperature_avg
     ''')
 
-    data = cursor.fetchall()
-    conn.close()
-    return data
+    return cursor.fetchall()
 
-
-
-def make_scatter_plot(data):
+@instrumented()
+def make_scatter_plot(data, output_path=None):
     """Create scatter plot for Temperature vs Number of Crashes"""
+    import matplotlib.pyplot as plt
     
     temperatures = [entry[1] for entry in data]
     num_crashes = [entry[2] if entry[2] else 0 for entry in data]  # Replace None with 0 if no crashes
@@ -47,49 +65,22 @@ def make_scatter_plot(data):
     plt.grid(True, linestyle='--', alpha=0.5)
     
     # Show the plot
-    plt.show()
-
-def fetch_temperature_bins_vs_fatal_crashes_data():
-    """Fetch data for Temperature Bins vs Average Fatal Crashes per Day analysis"""
-    conn = sqlite3.connect('proj_data.db')
-    cursor = conn.cursor()
+    show_or_save(output_path)
 
-    cursor.execute('''
-        SELECT
-            CASE
-                WHEN temperature_avg BETWEEN 0 AND 10 THEN '0-10'
-                WHEN temperature_avg BETWEEN 11 AND 20 THEN '11-20'
-                WHEN temperature_avg BETWEEN 21 AND 30 THEN '21-30'
-                WHEN temperature_avg BETWEEN 31 AND 40 THEN '31-40'
-                WHEN temperature_avg BETWEEN 41 AND 50 THEN '41-50'
-                WHEN temperature_avg BETWEEN 51 AND 60 THEN '51-60'
-                WHEN temperature_avg BETWEEN 61 AND 70 THEN '61-70'
-                WHEN temperature_avg BETWEEN 71 AND 80 THEN '71-80'
-                WHEN temperature_avg BETWEEN 81 AND 90 THEN '81-90'
-                ELSE 'Unknown'
-            END as temperature_bin,
-            COUNT(crashes.id) as num_fatal_crashes,
-            COUNT(DISTINCT strftime('%Y-%m-%d', daily_data_meteostat.date)) as num_days
-        FROM
-            daily_data_meteostat
-        LEFT JOIN
-            crashes
-        ON
-            strftime('%Y-%m-%d', daily_data_meteostat.date) = strftime('%Y-%m-%d', crashes.CrashDate)
-        WHERE
-            crashes.Fatals > 0
-        GROUP BY
-            temperature_bin
-        ORDER BY
-            temperature_bin;
-    ''')
+@instrumented(rows='result')
+def fetch_temperature_bins_vs_fatal_crashes_data(cursor, variable='tavg', width=10, origin=0):
+    """Fetch data for Temperature Bins vs Average Fatal Crashes per Day analysis
 
-    data = cursor.fetchall()
-    conn.close()
-    return data
+    Every day in the crash period counts towards its bin, including days without a fatal crash.
+    """
+    daily = fetch_daily_fatal_crashes(cursor)
+    return bin_days(daily[variable], daily['fatal_crashes'], width, origin)
 
-def make_bar_chart(data):
+@instrumented()
+def make_bar_chart(data, output_path=None):
     """Create bar chart for Temperature Bins vs Average Fatal Crashes per Day"""
+    import matplotlib.pyplot as plt
+
     # Extract data for plotting
     temperature_bins = [entry[0] for entry in data]
     num_fatal_crashes = [entry[1] for entry in data]
@@ -112,85 +103,48 @@ def make_bar_chart(data):
     plt.grid(axis='y', linestyle='--', alpha=0.7)
     plt.xticks(fontsize=12)
     plt.yticks(fontsize=12)
-    plt.show()
+    show_or_save(output_path)
 
     return temperature_bins,num_fatal_crashes,num_days
 
-def fetch_crash_details_data():
-    """Fetch data for crashes by intersection type, involvement of drunk drivers, and counts for each weekday"""
-    conn = sqlite3.connect('proj_data.db')
-    cursor = conn.cursor()
-
+@instrumented(rows='result')
+def fetch_crash_details_data(cursor):
+    """Count crash details per intersection type, drunk driver count and weekday in one GROUP BY"""
     cursor.execute('''
         SELECT
-            crash_details.id,
+            intersection_types.type_name,
             crash_details.drunk,
             crash_details.weekday,
-            crash_details.type_id
+            COUNT(*) as num_crashes
         FROM
             crash_details
+        LEFT JOIN
+            intersection_types
+        ON
+            crash_details.type_id = intersection_types.type_id
+        GROUP BY
+            crash_details.type_id, crash_details.drunk, crash_details.weekday
     ''')
-
-    data = cursor.fetchall()
-    conn.close()
-    return data
+    return cursor.fetchall()
 
 def analyze_crash_details(data):
-    """Analyze crash details and print counts for different categories"""
-    # Count crashes by intersection type
+    """Fold the grouped crash detail counts into the three breakdowns"""
     intersection_counts = {}
-    for entry in data:
-        intersection_type = entry[3]
-        if intersection_type in intersection_counts:
-            intersection_counts[intersection_type] += 1
-        else:
-            intersection_counts[intersection_type] = 1
-
-    # Count crashes involving drunk drivers
     drunk_counts = {"Drunk": 0, "Not Drunk": 0}
-    for entry in data:
-        drunk_status = "Drunk" if entry[1] == 1 else "Not Drunk"
-        drunk_counts[drunk_status] += 1
-
-    # Count crashes for each weekday
     weekday_counts = {int(i): 0 for i in range(1,8)}
-    for entry in data:
-        weekday = entry[2]
-        weekday_counts[weekday] += 1
 
-    return intersection_counts, drunk_counts, weekday_counts
+    # One pass over the (type, drunk, weekday) groups, each already counted in SQL
+    for type_name, drunk, weekday, count in data:
+        intersection_type = type_name if type_name else 'Unknown'
+        intersection_counts[intersection_type] = intersection_counts.get(intersection_type, 0) + count
+        drunk_counts["Drunk" if drunk == 1 else "Not Drunk"] += count
+        weekday_counts[weekday] = weekday_counts.get(weekday, 0) + count
 
-def print_crash_details_counts(intersection_counts, drunk_counts, weekday_counts, ):
-    """Print counts for crash details"""
-
-    with open('calcs.txt', 'a') as fhand:
-        fhand.write("\nCrash Details Counts:")
-        fhand.write("---------------------")
-        
-        # Intersection Type Counts
-        conn = sqlite3.connect('proj_data.db')
-        cursor = conn.cursor()
-        fhand.write("\n1. Intersection Type Counts:\n")
-        for intersection_type, count in intersection_counts.items():
-            cursor.execute("Select type_name FROM intersection_types where type_id = ?", (intersection_type,))
-            fhand.write(f"   - {cursor.fetchone()[0]}: {count}\n")
-
-        # Drunk Driver Involvement Counts
-        fhand.write("\n2. Drunk Driver Involvement Counts:\n")
-        for drunk_status, count in drunk_counts.items():
-            fhand.write(f"   - {drunk_status}: {count}\n")
-
-        # Weekday Counts
-        fhand.write("\n3. Weekday Counts(1 corresponds to monday):\n")
-        for weekday, count in weekday_counts.items():
-            fhand.write(f"   - Weekday {weekday}: {count}\n")
-    
-
-def make_drunk_fatalities_comparison_chart():
-    """Create a bar chart for the count of deaths based on the number of drunk drivers"""
-    conn = sqlite3.connect('proj_data.db')
-    cursor = conn.cursor()
+    return intersection_counts, drunk_counts, weekday_counts
 
+@instrumented(rows='result')
+def fetch_drunk_fatalities_data(cursor):
+    """Fetch data for the count of deaths based on the number of drunk drivers"""
     cursor.execute('''
         SELECT
             drunk,
@@ -205,8 +159,12 @@ def make_drunk_fatalities_comparison_chart():
             drunk;
     ''')
 
-    data = cursor.fetchall()
-    conn.close()
+    return cursor.fetchall()
+
+@instrumented()
+def make_drunk_fatalities_comparison_chart(data, output_path=None):
+    """Create a bar chart for the count of deaths based on the number of drunk drivers"""
+    import matplotlib.pyplot as plt
 
     drunk_counts = [entry[1] if entry[1] else 0 for entry in data]  # Replace None with 0
     labels = [f'{entry[0]} Drunk Drivers' if entry[0] else 'No Drunk Drivers' for entry in data]
@@ -227,13 +185,11 @@ def make_drunk_fatalities_comparison_chart():
     plt.xticks(rotation=45, ha='right', fontsize=12)
     plt.yticks(fontsize=12)
     plt.tight_layout()  # Adjust layout to prevent labels from going out of the window
-    plt.show()
-
-def make_intersection_pie():
-    """Create a pie chart for intersection types distribution"""
-    conn = sqlite3.connect('proj_data.db')
-    cursor = conn.cursor()
+    show_or_save(output_path)
 
+@instrumented(rows='result')
+def fetch_intersection_type_data(cursor):
+    """Fetch data for intersection types distribution"""
     cursor.execute('''
         SELECT
             intersection_types.type_name,
@@ -248,8 +204,12 @@ def make_intersection_pie():
             crash_details.type_id
     ''')
 
-    data = cursor.fetchall()
-    conn.close()
+    return cursor.fetchall()
+
+@instrumented()
+def make_intersection_pie(data, output_path=None):
+    """Create a pie chart for intersection types distribution"""
+    import matplotlib.pyplot as plt
 
     # Extract data for plotting
     types = [entry[0] if entry[0] else 'Unknown' for entry in data]
@@ -277,39 +237,101 @@ def make_intersection_pie():
     plt.title('Distribution of Crash Types by Intersection', fontsize=16)
 
     # Show the plot
-    plt.show()
-
-def main():
-    # Fetch data for scatter plot
-    temperature_vs_crashes_data = fetch_temperature_vs_crashes_data()
-
-    # Create scatter plot
-    make_scatter_plot(temperature_vs_crashes_data)
-
-    # Fetch data for bar chart
-    temperature_bins_vs_fatal_crashes_data = fetch_temperature_bins_vs_fatal_crashes_data()
-
-    # Create bar chart
-    bins, crashes, days = make_bar_chart(temperature_bins_vs_fatal_crashes_data)
-    with open('calcs.txt', 'w')  as fhand:
-        # Display calculated values
-        fhand.write("\nCalculated Values:")
-        fhand.write("------------------")
-        fhand.write("\n1. Bar Chart: Temperature Bins vs Average Fatal Crashes per Day\n")
-        for num,bin in enumerate(bins):
-            fhand.write(f"   - Temperature Bin: {bin}, Average Fatal Crashes per Day: {crashes[num]/days[num]}\n")
-        
-        # Fetch data for crash details
-    crash_details_data = fetch_crash_details_data()
-
-    # Analyze crash details
-    intersection_counts, drunk_counts, weekday_counts = analyze_crash_details(crash_details_data)
-
-    # Print counts for crash details
-    print_crash_details_counts(intersection_counts, drunk_counts, weekday_counts)
-
-    make_drunk_fatalities_comparison_chart()
-    make_intersection_pie()
+    show_or_save(output_path)
+
+# Chart name -> (fetch function, render function)
+CHARTS = {
+    'temperature_vs_crashes': (fetch_temperature_vs_crashes_data, make_scatter_plot),
+    'temperature_bins_vs_fatal_crashes': (fetch_temperature_bins_vs_fatal_crashes_data, make_bar_chart),
+    'drunk_fatalities': (fetch_drunk_fatalities_data, make_drunk_fatalities_comparison_chart),
+    'intersection_types': (fetch_intersection_type_data, make_intersection_pie),
+}
+
+def data_hash(data):
+    """Hash the input data of a chart so unchanged charts can be skipped"""
+    return hashlib.sha256(repr(data).encode()).hexdigest()
+
+def fetch_with_pool(pool, fetch):
+    """Run one fetch function on a connection borrowed from the read-only pool"""
+    with pool.connection() as conn:
+        return fetch(conn.cursor())
+
+def fetch_all(pool, fetches):
+    """Run {name: fetch function} concurrently on the read-only pool and return {name: data}"""
+    # sqlite3 releases the GIL while a query runs, so the readers overlap
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        futures = {name: executor.submit(fetch_with_pool, pool, fetch) for name, fetch in fetches.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+def render_chart(name, data, output_path):
+    """Render one chart to a file with the non-interactive backend"""
+    import matplotlib
+    matplotlib.use('Agg')
+    CHARTS[name][1](data, output_path)
+    # Hand this process's timings back to the parent, which prints the summary
+    return name, instrumentation.snapshot()
+
+def render_charts(chart_data, output_dir, fmt='png', jobs=None):
+    """Render every chart whose data changed since the last run to output_dir in a process pool"""
+    os.makedirs(output_dir, exist_ok=True)
+    hashes_path = os.path.join(output_dir, 'chart_hashes.json')
+    try:
+        with open(hashes_path, 'r') as file:
+            previous_hashes = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        previous_hashes = {}
+
+    hashes = {}
+    to_render = []
+    for name, data in chart_data.items():
+        output_path = os.path.join(output_dir, f'{name}.{fmt}')
+        hashes[name] = data_hash(data)
+        if hashes[name] == previous_hashes.get(name) and os.path.exists(output_path):
+            print(f"Skipping {name}, data unchanged")
+            continue
+        to_render.append((name, data, output_path))
+
+    # Workers start from empty statistics so only their own calls are merged back
+    with ProcessPoolExecutor(max_workers=jobs, initializer=instrumentation.reset) as executor:
+        futures = [executor.submit(render_chart, *args) for args in to_render]
+        for future in futures:
+            name, recorded = future.result()
+            instrumentation.merge(recorded)
+            print(f"Rendered {name}")
+
+    with open(hashes_path, 'w') as file:
+        json.dump(hashes, file, indent=2)
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Analyze proj_data.db and draw the charts")
+    parser.add_argument('--output-dir', help="render charts headless into this directory instead of showing them")
+    parser.add_argument('--format', choices=['png', 'svg'], default='png', help="file format for --output-dir")
+    parser.add_argument('--jobs', type=int, help="number of processes rendering charts")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.setup(args)
+
+    # Make sure the day keys and daily aggregates the queries rely on exist
+    conn = database.get_connection()
+    migrate(conn)
+    print(weather_source(conn.cursor()))
+
+    # Fetch data for every chart on read-only connections, which keep working while an
+    # ingest script holds the write lock
+    pool = database.get_read_pool()
+    chart_data = fetch_all(pool, {name: fetch for name, (fetch, _) in CHARTS.items()})
+
+    # calcs.txt and calcs.json, recomputing only the sections whose tables changed
+    # (imported here because report.py builds on this module)
+    from report import generate_report
+    generate_report(pool)
+    database.close()
+
+    if args.output_dir:
+        render_charts(chart_data, args.output_dir, args.format, args.jobs)
+    else:
+        for name, (_, render) in CHARTS.items():
+            render(chart_data[name])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+def create_ingest_state_table(cursor):
+    """Create ingest_state table in the database if not exists"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_state (
+            pipeline TEXT PRIMARY KEY,
+            position TEXT,
+            updated_at TEXT
+        )
+    ''')
+
+def get_state(cursor, pipeline, default=None):
+    """Return the saved position of a pipeline, or default if it never ran"""
+    cursor.execute('SELECT position FROM ingest_state WHERE pipeline = ?', (pipeline,))
+    row = cursor.fetchone()
+    return row[0] if row is not None else default
+
+def set_state(cursor, pipeline, position):
+    """Record the position of a pipeline; commit it together with the rows it describes"""
+    cursor.execute('''
+        INSERT OR REPLACE INTO ingest_state (pipeline, position, updated_at) VALUES (?, ?, ?)
+    ''', (pipeline, str(position), datetime.utcnow().isoformat(timespec='seconds')))
+
+def version_key(table):
+    """ingest_state pipeline name holding the change counter of a table"""
+    return f'version:{table}'
+
+def bump_version(cursor, table):
+    """Count a rewrite of a table's rows in the same transaction as the rewrite
+
+    Deleting and reinserting rows can leave MAX(rowid) and COUNT(*) unchanged, so writers
+    that do it bump this counter for report.py to notice. Before migrate() has created
+    ingest_state nothing can have been cached, so there is nothing to bump.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ingest_state'")
+    if cursor.fetchone() is None:
+        return
+    cursor.execute('''
+        INSERT INTO ingest_state (pipeline, position, updated_at) VALUES (?, 1, ?)
+        ON CONFLICT (pipeline) DO UPDATE SET position = position + 1, updated_at = excluded.updated_at
+    ''', (version_key(table), datetime.utcnow().isoformat(timespec='seconds')))
@@ -0,0 +1,271 @@
+import atexit
+import cProfile
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# 1 turns timing on; the other two name the cProfile and folded-stack files to write at exit
+INSTRUMENT_ENV = 'CRASHDB_INSTRUMENT'
+PROFILE_ENV = 'CRASHDB_PROFILE'
+TRACE_ENV = 'CRASHDB_TRACE'
+
+_lock = threading.Lock()
+_local = threading.local()
+# Read at import so worker processes started by an instrumented run record too
+_enabled = os.environ.get(INSTRUMENT_ENV, '') not in ('', '0')
+_stats = {}
+_stacks = defaultdict(float)
+
+class CallStats:
+    """Latency histogram and row count of one instrumented function"""
+
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+        # Bucket k counts calls that took under 2**k microseconds
+        self.buckets = defaultdict(int)
+
+    def add(self, elapsed, rows=0):
+        self.calls += 1
+        self.rows += rows
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.buckets[int(elapsed * 1e6).bit_length()] += 1
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.rows += other.rows
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] += count
+
+    def percentile(self, fraction):
+        """Upper bound in seconds of the bucket holding the given fraction of calls"""
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= fraction * self.calls:
+                return min(2 ** bucket / 1e6, self.max)
+        return self.max
+
+def enabled():
+    """Check whether instrumented calls are being recorded"""
+    return _enabled
+
+def record(name, elapsed, rows=0):
+    """Add one call of name to the statistics"""
+    with _lock:
+        if name not in _stats:
+            _stats[name] = CallStats()
+        _stats[name].add(elapsed, rows)
+
+def count_rows(value):
+    """Rows represented by a result or argument: an int as is, else its length"""
+    if value is None:
+        return 0
+    if isinstance(value, int):
+        return value
+    try:
+        return len(value)
+    except TypeError:
+        return 0
+
+def _stack():
+    """This thread's stack of open spans"""
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+@contextmanager
+def span(name, rows=0):
+    """Time a block as a call of name, nested under any instrumented call around it"""
+    if not _enabled:
+        yield
+        return
+    stack = _stack()
+    # Each frame is [name, seconds spent in nested spans]
+    stack.append([name, 0.0])
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _, children = stack.pop()
+        path = ';'.join(frame[0] for frame in stack + [[name]])
+        with _lock:
+            _stacks[path] += elapsed - children
+        if stack:
+            stack[-1][1] += elapsed
+        record(name, elapsed, rows)
+
+def timed_iter(name, iterable):
+    """Yield from an iterable, recording the time spent producing its items as one call of name
+
+    A span held open across the yields would also time what the consumer does with each
+    item, so only the steps of the iterable are timed, and recorded together once it ends.
+    """
+    if not _enabled:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    elapsed = children = 0.0
+    items = 0
+    path = None
+    try:
+        while True:
+            # The consumer may resume the iterable from another thread, so the stack is looked up every step
+            stack = _stack()
+            if path is None:
+                path = ';'.join(frame[0] for frame in stack + [[name]])
+            stack.append([name, 0.0])
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                step = time.perf_counter() - started
+                elapsed += step
+                children += stack.pop()[1]
+                if stack:
+                    stack[-1][1] += step
+            items += 1
+            yield item
+    finally:
+        with _lock:
+            _stacks[path] += elapsed - children
+        record(name, elapsed, items)
+
+def instrumented(name=None, rows=None):
+    """Decorate a function to record its latency when instrumentation is on
+
+    rows names the argument, or 'result' for the return value, whose length (or value,
+    for an int) is added to the function's row count.
+    """
+    def decorate(func):
+        # Named after the file rather than __module__, which is __main__ for the script being run
+        label = name or f'{inspect.getmodulename(inspect.getfile(func))}.{func.__name__}'
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            count = 0
+            if rows not in (None, 'result'):
+                count = count_rows(signature.bind(*args, **kwargs).arguments.get(rows))
+            with span(label):
+                result = func(*args, **kwargs)
+            if rows == 'result':
+                count = count_rows(result)
+            if count:
+                with _lock:
+                    _stats[label].rows += count
+            return result
+        return wrapper
+    return decorate
+
+def reset():
+    """Drop everything recorded so far, such as the statistics a forked worker inherits"""
+    with _lock:
+        _stats.clear()
+        _stacks.clear()
+
+def snapshot():
+    """Return and clear the statistics recorded so far, for handing back from a worker process"""
+    with _lock:
+        stats, stacks = dict(_stats), dict(_stacks)
+        _stats.clear()
+        _stacks.clear()
+    return stats, stacks
+
+def merge(recorded):
+    """Fold statistics from snapshot() in another process into this one"""
+    stats, stacks = recorded
+    with _lock:
+        for name, call_stats in stats.items():
+            _stats.setdefault(name, CallStats()).merge(call_stats)
+        for path, seconds in stacks.items():
+            _stacks[path] += seconds
+
+def format_histogram(call_stats):
+    """One line of 'under N: calls' buckets"""
+    parts = []
+    for bucket in sorted(call_stats.buckets):
+        limit = 2 ** bucket
+        label = f'{limit}us' if limit < 1000 else f'{limit / 1000:.3g}ms' if limit < 1e6 else f'{limit / 1e6:.3g}s'
+        parts.append(f'<{label}: {call_stats.buckets[bucket]}')
+    return ', '.join(parts)
+
+def summary():
+    """Text table of every instrumented function, slowest in total first"""
+    with _lock:
+        stats = sorted(_stats.items(), key=lambda item: item[1].total, reverse=True)
+    lines = [f"{'function':<55} {'calls':>7} {'rows':>9} {'total s':>9} {'mean ms':>9} "
+             f"{'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}"]
+    for name, call_stats in stats:
+        lines.append(f"{name:<55} {call_stats.calls:>7} {call_stats.rows:>9} {call_stats.total:>9.3f} "
+                     f"{call_stats.total / call_stats.calls * 1000:>9.2f} "
+                     f"{call_stats.percentile(0.5) * 1000:>8.2f} {call_stats.percentile(0.95) * 1000:>8.2f} "
+                     f"{call_stats.max * 1000:>8.2f}")
+        lines.append(f"    {format_histogram(call_stats)}")
+    return '\n'.join(lines)
+
+def write_trace(path):
+    """Write the instrumented call stacks in the folded format flamegraph.pl and speedscope read
+
+    Each line is 'outer;inner self-time', with self-time in microseconds.
+    """
+    with _lock:
+        stacks = dict(_stacks)
+    with open(path, 'w') as file:
+        for stack, seconds in sorted(stacks.items()):
+            file.write(f'{stack} {max(int(seconds * 1e6), 0)}\n')
+
+def add_arguments(parser):
+    """Add the --instrument, --profile and --trace options to a script's parser"""
+    group = parser.add_argument_group('instrumentation')
+    group.add_argument('--instrument', action='store_true',
+                       help=f"time the fetch, insert, query and render calls and print a summary at exit "
+                            f"(or set {INSTRUMENT_ENV}=1)")
+    group.add_argument('--profile', metavar='PATH',
+                       help=f"also write cProfile stats of the main thread to PATH (or set {PROFILE_ENV})")
+    group.add_argument('--trace', metavar='PATH',
+                       help=f"also write the instrumented call stacks as folded stacks to PATH (or set {TRACE_ENV})")
+
+def setup(args=None):
+    """Turn instrumentation on from the command line or environment, reporting at exit"""
+    global _enabled
+    profile_path = getattr(args, 'profile', None) or os.environ.get(PROFILE_ENV)
+    trace_path = getattr(args, 'trace', None) or os.environ.get(TRACE_ENV)
+    if not (getattr(args, 'instrument', False) or _enabled or profile_path or trace_path):
+        return
+    _enabled = True
+    # Inherited by worker processes, which then record on import
+    os.environ[INSTRUMENT_ENV] = '1'
+
+    profiler = None
+    if profile_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def report():
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            print(f"Wrote cProfile stats to {profile_path}", file=sys.stderr)
+        if trace_path:
+            write_trace(trace_path)
+            print(f"Wrote folded call stacks to {trace_path}", file=sys.stderr)
+        print(summary(), file=sys.stderr)
+
+    atexit.register(report)
@@ -0,0 +1,70 @@
+import codecs
+import json
+import re
+
+# A whole (possibly unterminated) string, or a character that changes the structure of the document
+TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)(")?|[{}\[\]]')
+
+def iter_results(chunks, key='Results'):
+    """Yield the objects of data[key][0] one at a time from an iterable of byte chunks
+
+    Only the object currently being read is held in memory, so a response of any
+    size is parsed with flat memory use.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    object_decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    depth = 0
+    last_string = None
+    results_depth = None
+    inner_arrays = 0
+
+    while True:
+        match = TOKEN.search(buf, pos)
+        if match is not None:
+            token = match.group()
+            index = match.start()
+            if token[0] == '"':
+                if match.group(2) is not None:
+                    if depth == 1:
+                        last_string = match.group(1)
+                    pos = match.end()
+                    continue
+                # The string runs past the buffer, read more and start again from its quote
+                pos = index
+            elif token == '{' and results_depth is not None and depth == results_depth + 1 and inner_arrays == 1:
+                # A result object: let the json module parse it whole once it is fully buffered
+                try:
+                    item, pos = object_decoder.raw_decode(buf, index)
+                except json.JSONDecodeError:
+                    pos = index
+                else:
+                    yield item
+                    buf = buf[pos:]
+                    pos = 0
+                    continue
+            else:
+                pos = match.end()
+                if token in '{[':
+                    depth += 1
+                    if token == '[' and depth == 2 and last_string == key:
+                        results_depth = depth
+                    elif token == '[' and results_depth is not None and depth == results_depth + 1:
+                        inner_arrays += 1
+                else:
+                    depth -= 1
+                    if results_depth is not None and depth < results_depth:
+                        results_depth = None
+                continue
+
+        # Nothing complete left in the buffer: keep only what is still needed and read on
+        buf = buf[pos:]
+        pos = 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            if buf.strip():
+                raise ValueError("Truncated JSON response")
+            return
+        buf += decoder.decode(chunk)
@@ -0,0 +1,195 @@
+import os
+import re
+import sqlite3
+
+import database
+from daily_stats import create_daily_crash_stats_table, rebuild_daily_crash_stats
+from ingest_state import bump_version, create_ingest_state_table, set_state
+
+# Progress files used before ingest_state existed, and the pipeline each one belongs to
+LEGACY_STATE_FILES = {
+    'crashes': 'start_index.txt',
+    'crash_details': 'details_index.txt',
+    'weather': 'last_end_date.txt',
+}
+
+# SQLite expression turning a date/datetime TEXT column into the day key from dates.py
+DAY_KEY_SQL = "CAST(julianday(date({column})) - 2440587.5 AS INTEGER)"
+
+# Secondary indexes for the graph.py queries, as (name, table, columns and optional WHERE)
+ANALYSIS_INDEXES = [
+    # GROUP BY type_id, drunk, weekday and GROUP BY type_id read only this index
+    ('crash_details_type_drunk_weekday', 'crash_details', '(type_id, drunk, weekday)'),
+    # GROUP BY drunk joined back to crashes by id, which the index carries as the rowid
+    ('crash_details_drunk', 'crash_details', '(drunk)'),
+    # The fatal crash days, the pre-aggregated form of crashes.Fatals > 0
+    ('daily_crash_stats_fatal', 'daily_crash_stats', '(day, county_id, fatal_crashes) WHERE fatal_crashes > 0'),
+    # Date range, county and state slices in query.py seek to each (State, county_id) run of days,
+    # and the trailing columns answer their per-day sums without touching the table
+    ('crashes_state_county_day', 'crashes', '(State, county_id, day, Fatals, Persons, TotalVehicles)'),
+]
+
+def table_exists(cursor, table):
+    """Check whether a table exists in the database"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cursor.fetchone() is not None
+
+def column_exists(cursor, table, column):
+    """Check whether a table has the given column"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cursor.fetchall())
+
+def add_day_key(cursor, table, date_column):
+    """Add an indexed integer day column to a table and backfill it from its date column"""
+    if not table_exists(cursor, table):
+        return
+    if not column_exists(cursor, table, 'day'):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN day INTEGER")
+        cursor.execute(f"UPDATE {table} SET day = {DAY_KEY_SQL.format(column=date_column)}")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_day ON {table}(day)")
+
+def add_analysis_indexes(cursor):
+    """Create the indexes the analysis queries rely on for every table that exists"""
+    for name, table, definition in ANALYSIS_INDEXES:
+        if table_exists(cursor, table):
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}{definition}")
+
+def add_epoch_columns(cursor):
+    """Replace the CrashDate TEXT column of crashes with integer epoch and year columns"""
+    if not table_exists(cursor, 'crashes') or not column_exists(cursor, 'crashes', 'CrashDate'):
+        return
+    for column in ('epoch', 'year'):
+        if not column_exists(cursor, 'crashes', column):
+            cursor.execute(f"ALTER TABLE crashes ADD COLUMN {column} INTEGER")
+    # CrashDate holds UTC datetimes written by crash.py, so %s gives back the original epoch.
+    # The case year is the year in Michigan, the only state loaded then, which the API gave as UTC-5.
+    cursor.execute('''
+        UPDATE crashes SET
+            epoch = CAST(strftime('%s', CrashDate) AS INTEGER),
+            year = CAST(strftime('%Y', CrashDate, '-5 hours') AS INTEGER)
+        WHERE epoch IS NULL AND CrashDate IS NOT NULL
+    ''')
+    # DROP COLUMN needs SQLite 3.35; older versions keep the unused column
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        cursor.execute("ALTER TABLE crashes DROP COLUMN CrashDate")
+
+def unique_constraints(cursor, table):
+    """List the column tuples of a table's UNIQUE constraints"""
+    cursor.execute(f"PRAGMA index_list({table})")
+    names = [row[1] for row in cursor.fetchall() if row[3] == 'u']
+    constraints = []
+    for name in names:
+        cursor.execute(f"PRAGMA index_info({name})")
+        constraints.append(tuple(row[2] for row in cursor.fetchall()))
+    return constraints
+
+def rebuild_crashes_unique(cursor):
+    """Rebuild crashes so it is unique on (State, St_Case, year) instead of St_Case alone
+
+    St_Case restarts every year, so the old constraint silently dropped every year after the
+    first. SQLite cannot alter a constraint, so the table is copied into a new one.
+    """
+    if not table_exists(cursor, 'crashes') or ('St_Case',) not in unique_constraints(cursor, 'crashes'):
+        return
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'crashes'")
+    sql = cursor.fetchone()[0]
+    sql = re.sub(r'UNIQUE\s*\(\s*St_Case\s*\)', 'UNIQUE(State, St_Case, year)', sql)
+    sql = re.sub(r'^CREATE TABLE\s+"?crashes"?', 'CREATE TABLE crashes_rebuilt', sql)
+    cursor.execute(sql)
+    # Same definition, so the columns line up; ids are kept for crash_details
+    cursor.execute("INSERT INTO crashes_rebuilt SELECT * FROM crashes")
+    # Dropping first and renaming the copy leaves references to crashes in other tables alone
+    cursor.execute("DROP TABLE crashes")
+    cursor.execute("ALTER TABLE crashes_rebuilt RENAME TO crashes")
+    cursor.execute("CREATE INDEX IF NOT EXISTS crashes_day ON crashes(day)")
+
+def add_county_state(cursor):
+    """Rebuild counties keyed by (State, county_name), splitting names that were shared by states
+
+    A county keeps its id for the lowest state it has crashes in; its crashes in any other
+    state move to a new county of that state. Station mappings of split counties are dropped
+    so weather.py --by-county maps each of them again.
+    """
+    if not table_exists(cursor, 'counties') or column_exists(cursor, 'counties', 'State'):
+        return
+    cursor.execute('''
+        CREATE TABLE counties_rebuilt (
+            county_id INTEGER PRIMARY KEY,
+            State INTEGER,
+            county_name TEXT,
+            UNIQUE(State, county_name) ON CONFLICT IGNORE
+        )
+    ''')
+    has_crashes = table_exists(cursor, 'crashes')
+    state = '(SELECT MIN(State) FROM crashes WHERE crashes.county_id = counties.county_id)' if has_crashes else 'NULL'
+    cursor.execute(f'''
+        INSERT INTO counties_rebuilt (county_id, State, county_name)
+        SELECT county_id, {state}, county_name FROM counties
+    ''')
+    split = []
+    if has_crashes:
+        cursor.execute('SELECT county_id FROM crashes GROUP BY county_id HAVING COUNT(DISTINCT State) > 1')
+        split = [row[0] for row in cursor.fetchall()]
+    if split:
+        placeholders = ', '.join('?' * len(split))
+        # The ids kept above conflict, so only the other states' counties are added
+        cursor.execute(f'''
+            INSERT INTO counties_rebuilt (State, county_name)
+            SELECT DISTINCT crashes.State, counties.county_name
+            FROM crashes JOIN counties ON counties.county_id = crashes.county_id
+            WHERE crashes.county_id IN ({placeholders})
+        ''', split)
+        cursor.execute(f'''
+            UPDATE crashes SET county_id = (
+                SELECT counties_rebuilt.county_id
+                FROM counties_rebuilt JOIN counties ON counties.county_name = counties_rebuilt.county_name
+                WHERE counties.county_id = crashes.county_id AND counties_rebuilt.State = crashes.State
+            )
+            WHERE county_id IN ({placeholders})
+        ''', split)
+        if table_exists(cursor, 'county_weather_stations'):
+            cursor.execute(f'DELETE FROM county_weather_stations WHERE county_id IN ({placeholders})', split)
+            bump_version(cursor, 'county_weather_stations')
+    cursor.execute('DROP TABLE counties')
+    cursor.execute('ALTER TABLE counties_rebuilt RENAME TO counties')
+    if split and table_exists(cursor, 'daily_crash_stats'):
+        rebuild_daily_crash_stats(cursor)
+
+def add_daily_crash_stats(cursor):
+    """Create the daily_crash_stats aggregate table and fill it from existing crashes"""
+    if table_exists(cursor, 'daily_crash_stats') or not table_exists(cursor, 'crashes'):
+        return
+    create_daily_crash_stats_table(cursor)
+    rebuild_daily_crash_stats(cursor)
+
+def add_ingest_state(cursor):
+    """Create the ingest_state table and seed it from the legacy progress files"""
+    if table_exists(cursor, 'ingest_state'):
+        return
+    create_ingest_state_table(cursor)
+    for pipeline, path in LEGACY_STATE_FILES.items():
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                set_state(cursor, pipeline, file.read().strip())
+
+def migrate(conn):
+    """Bring an existing proj_data.db up to the current schema"""
+    cursor = conn.cursor()
+    # First, so the table exists before any step below counts a table version in it
+    add_ingest_state(cursor)
+    add_day_key(cursor, 'crashes', 'CrashDate')
+    add_epoch_columns(cursor)
+    rebuild_crashes_unique(cursor)
+    add_county_state(cursor)
+    add_day_key(cursor, 'daily_data_meteostat', 'date')
+    add_daily_crash_stats(cursor)
+    add_analysis_indexes(cursor)
+    conn.commit()
+
+def main():
+    conn = database.get_connection()
+    migrate(conn)
+    database.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import io
+import json
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import database
+import json_stream
+from instrumentation import instrumented, span, timed_iter
+
+API_URL = "https://crashviewer.nhtsa.dot.gov/CrashAPI"
+CACHE_PATH = 'nhtsa_cache.sqlite'
+CACHE_TTL = 30 * 24 * 60 * 60  # Crash records for past years rarely change
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+SPOOL_BYTES = 16 * 1024 * 1024
+# Eviction frees the cache down to this fraction of its limit, so it runs once per many puts
+EVICT_TO = 0.9
+
+_session = None
+_cache = None
+# Running total of the cached body sizes, summed once when the cache is opened
+_cache_bytes = 0
+_lock = threading.Lock()
+
+class NHTSAError(Exception):
+    """Raised when a NHTSA endpoint cannot be fetched"""
+
+def get_session(pool_size=16):
+    """Return the shared requests session, keeping connections alive between calls"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+def get_cache():
+    """Open the response cache database, creating the table if needed"""
+    global _cache, _cache_bytes
+    with _lock:
+        if _cache is None:
+            _cache = database.connect(CACHE_PATH, check_same_thread=False)
+            _cache.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    body BLOB,
+                    size INTEGER,
+                    created REAL,
+                    last_used REAL
+                )
+            ''')
+            _cache.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)')
+            _cache.commit()
+            _cache_bytes = _cache.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        return _cache
+
+def set_cache_path(path):
+    """Move the response cache to another file, closing the one in use"""
+    global CACHE_PATH, _cache
+    with _lock:
+        if _cache is not None:
+            _cache.close()
+            _cache = None
+        CACHE_PATH = path
+
+def cache_key(url, params):
+    """Build the cache key for an endpoint and its query parameters"""
+    return url + '?' + urlencode(sorted((k, str(v)) for k, v in params.items()))
+
+def cache_lookup(key, ttl):
+    """Return the rowid of the cached response for a key if it is younger than ttl seconds"""
+    cache = get_cache()
+    global _cache_bytes
+    now = time.time()
+    with _lock:
+        row = cache.execute('SELECT rowid, created, size FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > ttl:
+            cache.execute('DELETE FROM responses WHERE key = ?', (key,))
+            cache.commit()
+            _cache_bytes -= row[2]
+            return None
+        cache.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now, key))
+        cache.commit()
+    return row[0]
+
+def cache_get(key, ttl):
+    """Return the cached body for a key if it is younger than ttl seconds"""
+    rowid = cache_lookup(key, ttl)
+    if rowid is None:
+        return None
+    # get_cache takes _lock itself, so it is called before the lock is held
+    cache = get_cache()
+    with _lock:
+        return cache.execute('SELECT body FROM responses WHERE rowid = ?', (rowid,)).fetchone()[0]
+
+def iter_cached_body(rowid, chunk_size=CHUNK_SIZE):
+    """Yield a cached response body in chunks without loading it whole"""
+    cache = get_cache()
+    if not hasattr(cache, 'blobopen'):
+        # Incremental blob I/O needs Python 3.11
+        with _lock:
+            yield cache.execute('SELECT body FROM responses WHERE rowid = ?', (rowid,)).fetchone()[0]
+        return
+
+    offset = 0
+    while True:
+        with _lock:
+            with cache.blobopen('responses', 'body', rowid, readonly=True) as blob:
+                blob.seek(offset)
+                chunk = blob.read(chunk_size)
+        if not chunk:
+            return
+        offset += len(chunk)
+        yield chunk
+
+def evict(cache, max_bytes):
+    """Delete the least recently used responses until the cache is back under EVICT_TO of max_bytes"""
+    global _cache_bytes
+    stale = []
+    for rowid, size in cache.execute('SELECT rowid, size FROM responses ORDER BY last_used'):
+        if _cache_bytes <= max_bytes * EVICT_TO:
+            break
+        stale.append((rowid,))
+        _cache_bytes -= size
+    cache.executemany('DELETE FROM responses WHERE rowid = ?', stale)
+
+def cache_put(key, body, max_bytes=CACHE_MAX_BYTES):
+    """Store a response body and evict the least recently used entries over max_bytes"""
+    cache_put_file(key, io.BytesIO(body), len(body), max_bytes)
+
+def cache_put_file(key, file, size, max_bytes=CACHE_MAX_BYTES):
+    """Store a response body read from a file object, copying it into the cache in chunks"""
+    global _cache_bytes
+    cache = get_cache()
+    now = time.time()
+    with _lock:
+        # A replaced response no longer counts towards the total
+        old = cache.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        _cache_bytes += size - (old[0] if old else 0)
+        if hasattr(cache, 'blobopen'):
+            cursor = cache.execute('''
+                INSERT OR REPLACE INTO responses (key, body, size, created, last_used)
+                VALUES (?, zeroblob(?), ?, ?, ?)
+            ''', (key, size, size, now, now))
+            with cache.blobopen('responses', 'body', cursor.lastrowid) as blob:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    blob.write(chunk)
+        else:
+            cache.execute('''
+                INSERT OR REPLACE INTO responses (key, body, size, created, last_used) VALUES (?, ?, ?, ?, ?)
+            ''', (key, file.read(), size, now, now))
+        if _cache_bytes > max_bytes:
+            evict(cache, max_bytes)
+        cache.commit()
+
+@instrumented()
+def request(url, params, retries=3, backoff=1.0, stream=False):
+    """GET a NHTSA endpoint with retries, returning the response or None if it failed"""
+    session = get_session()
+    for attempt in range(retries + 1):
+        try:
+            response = session.get(url, params=params, timeout=60, stream=stream)
+        except requests.RequestException as e:
+            print(f"Error: {e}")
+        else:
+            if response.status_code == 200:
+                return response
+            print(f"Error: {response.status_code}")
+            response.close()
+            # Only rate limiting and server errors are worth retrying
+            if response.status_code != 429 and response.status_code < 500:
+                return None
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+    return None
+
+def get_json(url, params, ttl=CACHE_TTL, use_cache=True, retries=3, backoff=1.0):
+    """GET a NHTSA endpoint and return the decoded JSON, served from the cache when possible"""
+    key = cache_key(url, params)
+    if use_cache:
+        body = cache_get(key, ttl)
+        if body is not None:
+            with span('nhtsa_api.json_decode'):
+                return json.loads(body)
+
+    response = request(url, params, retries, backoff)
+    if response is None:
+        return None
+    if use_cache:
+        cache_put(key, response.content)
+    with span('nhtsa_api.json_decode'):
+        return response.json()
+
+@instrumented()
+def download(url, params, ttl=CACHE_TTL, retries=3, backoff=1.0):
+    """Stream a response into the cache unless a fresh copy is there; return its rowid or None"""
+    key = cache_key(url, params)
+    rowid = cache_lookup(key, ttl)
+    if rowid is not None:
+        return rowid
+
+    response = request(url, params, retries, backoff, stream=True)
+    if response is None:
+        return None
+    # Spill to disk past SPOOL_BYTES so a large response never sits in memory
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as spool, response:
+        size = 0
+        try:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                spool.write(chunk)
+                size += len(chunk)
+        except requests.RequestException as e:
+            print(f"Error: {e}")
+            return None
+        spool.seek(0)
+        cache_put_file(key, spool, size)
+    return cache_lookup(key, ttl)
+
+def iter_results(url, params, ttl=CACHE_TTL, retries=3, backoff=1.0):
+    """Yield the Results[0] records of a response one at a time with flat memory use"""
+    rowid = download(url, params, ttl, retries, backoff)
+    if rowid is None:
+        raise NHTSAError(f"Could not fetch {cache_key(url, params)}")
+    # The parse runs as the caller consumes it, so it is timed step by step rather than by a span
+    yield from timed_iter('nhtsa_api.json_stream', json_stream.iter_results(iter_cached_body(rowid)))
@@ -0,0 +1,52 @@
+import json
+import zlib
+
+# Payloads read and decompressed per page when backfilling
+PAGE_SIZE = 1000
+
+def create_case_payloads_table(cursor):
+    """Create case_payloads table in the database if not exists"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS case_payloads (
+            St_Case INTEGER,
+            case_year INTEGER,
+            state INTEGER,
+            payload BLOB,
+            PRIMARY KEY (St_Case, case_year) ON CONFLICT REPLACE
+        )
+    ''')
+
+def compress_payload(case_details):
+    """Serialize a GetCaseDetails response compactly and zlib-compress it"""
+    return zlib.compress(json.dumps(case_details, separators=(',', ':')).encode(), 6)
+
+def decompress_payload(blob):
+    """Turn a stored payload back into the GetCaseDetails response"""
+    return json.loads(zlib.decompress(blob))
+
+def store_payloads(cursor, payloads):
+    """Save (St_Case, case_year, state, compressed payload) rows, replacing older copies"""
+    cursor.executemany('''
+        INSERT INTO case_payloads (St_Case, case_year, state, payload) VALUES (?, ?, ?, ?)
+    ''', payloads)
+
+def iter_stored_details(cursor, page_size=PAGE_SIZE):
+    """Yield pages of (crash id, GetCaseDetails response) for every crash with a stored payload"""
+    last_rowid = 0
+    while True:
+        # Page on rowid so each query starts where the last one ended
+        cursor.execute('''
+            SELECT case_payloads.rowid, crashes.id, case_payloads.payload
+            FROM case_payloads
+            JOIN crashes
+            ON crashes.St_Case = case_payloads.St_Case
+                AND crashes.year = case_payloads.case_year
+            WHERE case_payloads.rowid > ?
+            ORDER BY case_payloads.rowid
+            LIMIT ?
+        ''', (last_rowid, page_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        last_rowid = rows[-1][0]
+        yield [(id, decompress_payload(payload)) for _, id, payload in rows]
@@ -0,0 +1,204 @@
+import queue
+import threading
+import time
+
+# Marks the end of the items flowing into a stage
+DONE = object()
+
+class Checkpoint:
+    """Marker passed through a pipeline; the writer commits everything before it together with it
+
+    Checkpoints keep their place in the stream only through single-worker stages.
+    """
+
+    def __init__(self, pipeline, position):
+        self.pipeline = pipeline
+        self.position = position
+
+class Stage:
+    """One step of a pipeline, run by a fixed number of worker threads"""
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.input = None
+        self.lock = threading.Lock()
+
+    def record(self, elapsed, depth):
+        """Count one processed item"""
+        with self.lock:
+            self.items += 1
+            self.busy += elapsed
+            self.max_depth = max(self.max_depth, depth)
+
+class Pipeline:
+    """Threaded source -> stages -> writer pipeline with bounded queues between the stages
+
+    The source runs in its own thread, each stage in its worker threads, and the
+    writer in the calling thread, so a single thread owns the SQLite connection.
+    A stage function returns the item to pass on, or None to drop it. The writer
+    is called as write(batch, checkpoint) every batch_size items and at every
+    Checkpoint, and is expected to commit.
+    """
+
+    def __init__(self, source, stages, write, batch_size=500, queue_size=1000):
+        self.source = source
+        self.stages = [Stage(*stage) for stage in stages]
+        self.write = write
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.fetched = 0
+        self.writer = Stage('write', write)
+        self.failed = threading.Event()
+        self.error = None
+        self.started = None
+
+    def put(self, target, item):
+        """Put an item on a queue, giving up if the pipeline has failed"""
+        while not self.failed.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, source):
+        """Take an item from a queue, returning DONE if the pipeline has failed"""
+        while not self.failed.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return DONE
+
+    def fail(self, error):
+        """Stop every thread and remember the first error"""
+        if self.error is None:
+            self.error = error
+        self.failed.set()
+
+    def run_source(self, output):
+        """Feed the items of the source into the first queue"""
+        try:
+            for item in self.source:
+                self.fetched += 1
+                if not self.put(output, item):
+                    return
+            self.put(output, DONE)
+        except Exception as e:
+            self.fail(e)
+
+    def run_stage(self, stage, output, remaining):
+        """Worker loop of a stage; the last worker to finish passes DONE on"""
+        while True:
+            item = self.get(stage.input)
+            if item is DONE:
+                # Let the sibling workers see the end too
+                self.put(stage.input, DONE)
+                break
+            if isinstance(item, Checkpoint):
+                self.put(output, item)
+                continue
+            start = time.perf_counter()
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                self.fail(e)
+                return
+            stage.record(time.perf_counter() - start, stage.input.qsize())
+            if result is not None and not self.put(output, result):
+                return
+
+        with stage.lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            self.put(output, DONE)
+
+    def flush(self, batch, checkpoint=None):
+        """Hand a batch and optional checkpoint to the writer"""
+        if not batch and checkpoint is None:
+            return
+        start = time.perf_counter()
+        self.write(batch, checkpoint)
+        elapsed = time.perf_counter() - start
+        with self.writer.lock:
+            self.writer.items += len(batch)
+            self.writer.busy += elapsed
+
+    def run(self, report_every=None):
+        """Run the pipeline to completion and return its stats"""
+        self.started = time.perf_counter()
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self.run_source, args=(queues[0],), daemon=True)]
+        for stage, stage_input, output in zip(self.stages, queues, queues[1:]):
+            stage.input = stage_input
+            remaining = [stage.workers]
+            threads += [
+                threading.Thread(target=self.run_stage, args=(stage, output, remaining), daemon=True)
+                for _ in range(stage.workers)
+            ]
+        self.writer.input = queues[-1]
+        for thread in threads:
+            thread.start()
+
+        batch = []
+        last_report = time.perf_counter()
+        try:
+            while True:
+                item = self.get(self.writer.input)
+                if item is DONE:
+                    break
+                self.writer.max_depth = max(self.writer.max_depth, self.writer.input.qsize())
+                if isinstance(item, Checkpoint):
+                    self.flush(batch, item)
+                    batch = []
+                    continue
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self.flush(batch)
+                    batch = []
+                if report_every is not None and time.perf_counter() - last_report >= report_every:
+                    print(self.report())
+                    last_report = time.perf_counter()
+            if not self.failed.is_set():
+                self.flush(batch)
+        except Exception as e:
+            self.fail(e)
+
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.stats()
+
+    def stats(self):
+        """Per-stage item counts, throughput, busy share and queue depths"""
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        stats = {'source': {'items': self.fetched, 'per_second': self.fetched / elapsed,
+                            'queue_depth': self.stages[0].input.qsize() if self.stages else None}}
+        for stage in self.stages + [self.writer]:
+            stats[stage.name] = {
+                'items': stage.items,
+                'per_second': stage.items / elapsed,
+                'busy': stage.busy / (elapsed * stage.workers),
+                'queue_depth': stage.input.qsize(),
+                'max_queue_depth': stage.max_depth,
+            }
+        return stats
+
+    def report(self):
+        """Human readable summary of stats(), one line per stage"""
+        lines = []
+        for name, stage in self.stats().items():
+            line = f"{name:>10}: {stage['items']:>9} items {stage['per_second']:>9.1f}/s"
+            if 'busy' in stage:
+                line += (f"  busy {stage['busy']:>4.0%}  queue {stage['queue_depth']:>5}"
+                         f" (max {stage['max_queue_depth']}/{self.queue_size})")
+            lines.append(line)
+        return '\n'.join(lines)
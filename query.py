@@ -0,0 +1,163 @@
+import argparse
+import time
+from datetime import datetime
+
+import numpy as np
+
+import database
+from dates import day_key
+from migrations import migrate
+from temperature_bins import VARIABLES, has_county_weather
+
+def to_day_key(value):
+    """Day key of a date, datetime, 'YYYY-MM-DD' string or day key"""
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.strptime(value, '%Y-%m-%d')
+    return day_key(value)
+
+def county_ids(cursor, names, states=None):
+    """Return the county_ids for county names, given in full ('WAYNE (163)') or without the code ('Wayne')
+
+    A name matches the county of that name in every state unless states narrows it down.
+    """
+    state_filter = f"AND State IN ({', '.join('?' * len(states))})" if states else ''
+    ids = set()
+    for name in names:
+        cursor.execute(f'''
+            SELECT county_id FROM counties
+            WHERE (county_name = ? OR county_name LIKE ? || ' (%') {state_filter}
+        ''', (name, name, *(states or [])))
+        ids.update(row[0] for row in cursor.fetchall())
+    return sorted(ids)
+
+def distinct_states(cursor):
+    """List the states present in crashes with one index seek per state rather than a scan"""
+    states = []
+    cursor.execute('SELECT MIN(State) FROM crashes')
+    state = cursor.fetchone()[0]
+    while state is not None:
+        states.append(state)
+        cursor.execute('SELECT MIN(State) FROM crashes WHERE State > ?', (state,))
+        state = cursor.fetchone()[0]
+    return states
+
+def crash_slices(cursor, states=None, counties=None):
+    """List the (State, county_id) pairs present in crashes for a state and county selection
+
+    Pairs are found by seeking through the (State, county_id, day) index, so this costs one
+    lookup per county in the selected states whatever the number of crashes.
+    """
+    wanted = None if counties is None else set(counties)
+    slices = []
+    for state in (states if states is not None else distinct_states(cursor)):
+        cursor.execute('SELECT MIN(county_id) FROM crashes WHERE State = ?', (state,))
+        county_id = cursor.fetchone()[0]
+        while county_id is not None:
+            if wanted is None or county_id in wanted:
+                slices.append((state, county_id))
+            cursor.execute('SELECT MIN(county_id) FROM crashes WHERE State = ? AND county_id > ?', (state, county_id))
+            county_id = cursor.fetchone()[0]
+    return slices
+
+def daily_crashes(cursor, start, end, counties=None, states=None, fatal_only=False):
+    """Per-day crash counts in [start, end] as NumPy arrays, with zeros on days without crashes
+
+    Returns {'day', 'crashes', 'fatals', 'persons', 'vehicles'}, one entry per day of the range.
+    """
+    first_day, last_day = to_day_key(start), to_day_key(end)
+    fatal = 'AND Fatals > 0' if fatal_only else ''
+    if counties is None and states is None:
+        cursor.execute(f'''
+            SELECT day, COUNT(*), SUM(Fatals), SUM(Persons), SUM(TotalVehicles)
+            FROM crashes
+            WHERE day BETWEEN ? AND ? {fatal}
+            GROUP BY day
+        ''', (first_day, last_day))
+        rows = cursor.fetchall()
+    else:
+        slices = crash_slices(cursor, states, counties)
+        rows = []
+        if slices:
+            # Driving the join from the list of pairs makes each one a range seek on the covering index
+            cursor.execute(f'''
+                SELECT crashes.day, COUNT(*), SUM(Fatals), SUM(Persons), SUM(TotalVehicles)
+                FROM (VALUES {', '.join(['(?, ?)'] * len(slices))}) AS slice
+                CROSS JOIN crashes
+                ON crashes.State = slice.column1 AND crashes.county_id = slice.column2
+                WHERE crashes.day BETWEEN ? AND ? {fatal}
+                GROUP BY crashes.day
+            ''', [*(value for pair in slices for value in pair), first_day, last_day])
+            rows = cursor.fetchall()
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 5)
+
+    days = np.arange(first_day, last_day + 1)
+    result = {'day': days}
+    for i, name in enumerate(['crashes', 'fatals', 'persons', 'vehicles'], start=1):
+        # Scatter the grouped rows into a zero-filled array over the whole range
+        column = np.zeros(len(days), dtype=np.int64)
+        column[rows[:, 0] - first_day] = rows[:, i]
+        result[name] = column
+    return result
+
+def daily_temperatures(cursor, start, end, counties=None, variable='tavg'):
+    """Per-day temperature over [start, end] as a NumPy array, NaN where there is no reading
+
+    With a county set given and station weather for each of them on every day this is the
+    mean over those counties' stations; otherwise it is the Detroit reading.
+    """
+    first_day, last_day = to_day_key(start), to_day_key(end)
+    column = VARIABLES[variable]
+    if counties is not None and has_county_weather(cursor, counties, first_day, last_day):
+        cursor.execute(f'''
+            SELECT daily_weather.day, AVG(daily_weather.{column})
+            FROM county_weather_stations
+            JOIN daily_weather ON daily_weather.station_id = county_weather_stations.station_id
+            WHERE county_weather_stations.county_id IN ({', '.join('?' * len(counties))})
+                AND daily_weather.day BETWEEN ? AND ?
+            GROUP BY daily_weather.day
+        ''', [*counties, first_day, last_day])
+    else:
+        cursor.execute(f'''
+            SELECT day, {column} FROM daily_data_meteostat WHERE day BETWEEN ? AND ?
+        ''', (first_day, last_day))
+    rows = np.array(cursor.fetchall(), dtype=float).reshape(-1, 2)
+
+    temperatures = np.full(last_day - first_day + 1, np.nan)
+    temperatures[rows[:, 0].astype(np.int64) - first_day] = rows[:, 1]
+    return temperatures
+
+def crashes_vs_temperature(cursor, start, end, counties=None, states=None, variable='tavg', fatal_only=True):
+    """Daily crash counts and temperatures over [start, end], aligned day by day for plotting"""
+    result = daily_crashes(cursor, start, end, counties, states, fatal_only)
+    result['temperature'] = daily_temperatures(cursor, start, end, counties, variable)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Daily fatal crashes against temperature for a slice of the data")
+    parser.add_argument('--start', required=True, help="first day (YYYY-MM-DD)")
+    parser.add_argument('--end', required=True, help="last day (YYYY-MM-DD)")
+    parser.add_argument('--counties', nargs='+', help="county names, such as Wayne or 'WAYNE (163)'")
+    parser.add_argument('--states', type=int, nargs='+', help="state FIPS codes")
+    parser.add_argument('--variable', choices=list(VARIABLES), default='tavg')
+    args = parser.parse_args()
+
+    migrate(database.get_connection())
+    with database.get_read_pool().connection() as conn:
+        cursor = conn.cursor()
+        counties = county_ids(cursor, args.counties, args.states) if args.counties else None
+        started = time.perf_counter()
+        data = crashes_vs_temperature(cursor, args.start, args.end, counties, args.states, args.variable)
+        elapsed = time.perf_counter() - started
+    database.close()
+
+    measured = ~np.isnan(data['temperature'])
+    print(f"{len(data['day'])} days, {data['crashes'].sum()} fatal crashes, {data['fatals'].sum()} deaths "
+          f"({elapsed * 1000:.1f} ms)")
+    if measured.sum() > 1 and data['crashes'][measured].std() > 0:
+        correlation = np.corrcoef(data['temperature'][measured], data['crashes'][measured])[0, 1]
+        print(f"Correlation of daily fatal crashes with {args.variable}: {correlation:.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import re
+
+import database
+from daily_stats import aggregate_sql
+from graph import CHARTS, fetch_crash_details_data
+from migrations import migrate
+
+# Tables too large to read in full for a chart
+LARGE_TABLES = ('crashes', 'crash_details')
+
+# EXPLAIN QUERY PLAN detail of a scan that reads a table itself rather than an index
+FULL_SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?$')
+
+def explain(cursor, sql, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines of a statement"""
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return [row[3] for row in cursor.fetchall()]
+
+def analysis_queries(conn):
+    """Run every graph.py fetch and return the (name, sql) of each query it issued"""
+    fetches = {name: fetch for name, (fetch, _) in CHARTS.items()}
+    fetches['crash_details'] = fetch_crash_details_data
+    cursor = conn.cursor()
+
+    queries = []
+    for name, fetch in fetches.items():
+        statements = []
+        # The trace callback sees each statement with its parameters filled in
+        conn.set_trace_callback(statements.append)
+        try:
+            fetch(cursor)
+        finally:
+            conn.set_trace_callback(None)
+        queries += [(name, sql) for sql in statements
+                    if sql.lstrip().upper().startswith('SELECT') and 'sqlite_master' not in sql]
+
+    # Every ingest batch recomputes its days of daily_crash_stats with this query
+    refresh = aggregate_sql(cursor, 'WHERE crashes.day IN (0)')
+    queries.append(('refresh_daily_crash_stats', 'INSERT INTO daily_crash_stats ' + refresh))
+    return queries
+
+def check_query_plans(conn):
+    """Return (name, plan line) for every analysis query that scans a large table in full"""
+    cursor = conn.cursor()
+    problems = []
+    for name, sql in analysis_queries(conn):
+        for detail in explain(cursor, sql):
+            match = FULL_SCAN.match(detail)
+            if match is not None and match.group(1) in LARGE_TABLES:
+                problems.append((name, detail))
+    return problems
+
+def main():
+    conn = database.get_connection()
+    # The indexes being checked are created by the migrations
+    migrate(conn)
+
+    problems = check_query_plans(conn)
+    for name, detail in problems:
+        print(f"{name}: {detail}")
+    if problems:
+        print(f"{len(problems)} analysis queries scan crashes or crash_details in full")
+    else:
+        print("Every analysis query uses an index on crashes and crash_details")
+    database.close()
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,136 @@
+import argparse
+import json
+
+import database
+from graph import analyze_crash_details, fetch_crash_details_data, fetch_temperature_bins_vs_fatal_crashes_data
+from ingest_state import get_state, version_key
+from migrations import migrate, table_exists
+
+REPORT_PATH = 'calcs.txt'
+# Machine-readable copy of the report, which doubles as the cache of its sections
+JSON_PATH = 'calcs.json'
+
+def fetch_temperature_bins(cursor):
+    """Temperature bins as [bin, fatal crashes, days]"""
+    return [list(row) for row in fetch_temperature_bins_vs_fatal_crashes_data(cursor)]
+
+def fetch_crash_details_counts(cursor):
+    """The three crash details breakdowns, keyed by section"""
+    intersection_counts, drunk_counts, weekday_counts = analyze_crash_details(fetch_crash_details_data(cursor))
+    return {
+        'intersection_counts': intersection_counts,
+        'drunk_counts': drunk_counts,
+        # JSON object keys are strings
+        'weekday_counts': {str(weekday): count for weekday, count in weekday_counts.items()},
+    }
+
+# Source name -> (tables it reads, fetch function returning {section: data})
+SOURCES = {
+    'temperature_bins': (
+        ['daily_data_meteostat', 'daily_crash_stats', 'county_weather_stations', 'daily_weather'],
+        lambda cursor: {'temperature_bins': fetch_temperature_bins(cursor)},
+    ),
+    'crash_details': (
+        ['crash_details', 'intersection_types'],
+        fetch_crash_details_counts,
+    ),
+}
+
+# Report sections in calcs.txt order, with the source each comes from
+SECTIONS = {
+    'temperature_bins': 'temperature_bins',
+    'intersection_counts': 'crash_details',
+    'drunk_counts': 'crash_details',
+    'weekday_counts': 'crash_details',
+}
+
+def table_version(cursor, table):
+    """Cheap fingerprint of a table's contents: its highest rowid, row count and change counter
+
+    Inserts raise the highest rowid and deletes lower the count. Rewrites that reuse rowids,
+    such as the delete and reinsert of refresh_daily_crash_stats, bump the counter instead.
+    """
+    if not table_exists(cursor, table):
+        return None
+    cursor.execute(f'SELECT MAX(rowid), COUNT(*) FROM {table}')
+    return [*cursor.fetchone(), get_state(cursor, version_key(table))]
+
+def source_version(cursor, source):
+    """Fingerprint of every table a source reads"""
+    tables, _ = SOURCES[source]
+    return {table: table_version(cursor, table) for table in tables}
+
+def load_cached_sections(path=JSON_PATH):
+    """Read the sections saved by the last run, or nothing if there is no usable report"""
+    try:
+        with open(path, 'r') as file:
+            return json.load(file).get('sections', {})
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def build_sections(conn, cached=None, force=False):
+    """Return {section: {'version', 'data'}}, recomputing only sections whose tables changed"""
+    cached = cached or {}
+    cursor = conn.cursor()
+    sections = {}
+    # Read versions and data in one transaction so they describe the same snapshot
+    cursor.execute('BEGIN')
+    try:
+        for source in dict.fromkeys(SECTIONS.values()):
+            version = source_version(cursor, source)
+            names = [name for name, section_source in SECTIONS.items() if section_source == source]
+            if not force and all(cached.get(name, {}).get('version') == version for name in names):
+                print(f"Report sections from {source} are up to date")
+                sections.update({name: cached[name] for name in names})
+                continue
+            print(f"Recomputing report sections from {source}")
+            data = SOURCES[source][1](cursor)
+            sections.update({name: {'version': version, 'data': data[name]} for name in names})
+    finally:
+        cursor.execute('COMMIT')
+    return {name: sections[name] for name in SECTIONS}
+
+def format_report(sections):
+    """Render the report sections as the text of calcs.txt"""
+    lines = ["\nCalculated Values:", "------------------",
+             "\n1. Bar Chart: Temperature Bins vs Average Fatal Crashes per Day\n"]
+    for bin, crashes, days in sections['temperature_bins']['data']:
+        lines.append(f"   - Temperature Bin: {bin}, Average Fatal Crashes per Day: {crashes/days}\n")
+
+    lines += ["\nCrash Details Counts:", "---------------------", "\n1. Intersection Type Counts:\n"]
+    for intersection_type, count in sections['intersection_counts']['data'].items():
+        lines.append(f"   - {intersection_type}: {count}\n")
+    lines.append("\n2. Drunk Driver Involvement Counts:\n")
+    for drunk_status, count in sections['drunk_counts']['data'].items():
+        lines.append(f"   - {drunk_status}: {count}\n")
+    lines.append("\n3. Weekday Counts(1 corresponds to monday):\n")
+    for weekday, count in sections['weekday_counts']['data'].items():
+        lines.append(f"   - Weekday {weekday}: {count}\n")
+    return ''.join(lines)
+
+def generate_report(pool=None, report_path=REPORT_PATH, json_path=JSON_PATH, force=False):
+    """Bring calcs.txt and calcs.json up to date, recomputing only stale sections"""
+    pool = pool or database.get_read_pool()
+    with pool.connection() as conn:
+        sections = build_sections(conn, load_cached_sections(json_path), force)
+
+    # Both files are written whole once everything is computed and the connection is back in the pool
+    with open(report_path, 'w') as file:
+        file.write(format_report(sections))
+    with open(json_path, 'w') as file:
+        json.dump({'sections': sections}, file, indent=2)
+    return sections
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Write the calcs.txt report and its JSON copy")
+    parser.add_argument('--output', default=REPORT_PATH, help="text report")
+    parser.add_argument('--json', default=JSON_PATH, help="JSON report, also used as the section cache")
+    parser.add_argument('--force', action='store_true', help="recompute every section")
+    args = parser.parse_args(argv)
+
+    migrate(database.get_connection())
+    generate_report(report_path=args.output, json_path=args.json, force=args.force)
+    database.close()
+
+if __name__ == "__main__":
+    main()
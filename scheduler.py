@@ -0,0 +1,106 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from itertools import islice
+
+import database
+import nhtsa_api
+from crash import (case_list_request, create_counties_table, create_crashes_table, insert_crash_stream,
+                   iter_case_list)
+from dimensions import county_cache
+from ingest_state import get_state, set_state
+from migrations import migrate
+
+# FIPS codes of the 50 states plus DC
+ALL_STATES = [
+    1, 2, 4, 5, 6, 8, 9, 10, 11, 12, 13, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26,
+    27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 44, 45, 46, 47, 48,
+    49, 50, 51, 53, 54, 55, 56,
+]
+
+# Splitting by vehicle count keeps each GetCaseList response small
+DEFAULT_VEHICLE_RANGES = [(1, 1), (2, 2), (3, 6)]
+
+def unit_key(unit):
+    """ingest_state pipeline name recording the completion of a work unit"""
+    state, year, min_vehicles, max_vehicles = unit
+    return f'crashes:{state}:{year}:{min_vehicles}-{max_vehicles}'
+
+def plan_units(cursor, states, start_year, end_year, vehicle_ranges):
+    """List every (state, year, min vehicles, max vehicles) unit not completed yet"""
+    units = [
+        (state, year, min_vehicles, max_vehicles)
+        for year in range(start_year, end_year + 1)
+        for state in states
+        for min_vehicles, max_vehicles in vehicle_ranges
+    ]
+    return [unit for unit in units if get_state(cursor, unit_key(unit)) is None]
+
+def unit_request(unit):
+    """GetCaseList URL and parameters for one work unit"""
+    state, year, min_vehicles, max_vehicles = unit
+    return case_list_request(datetime(year, 1, 1), datetime(year, 12, 31), state, min_vehicles, max_vehicles)
+
+def fetch_unit(unit):
+    """Download the response of one work unit into the API cache"""
+    return unit, nhtsa_api.download(*unit_request(unit)) is not None
+
+def run_units(conn, cursor, units, max_workers=4):
+    """Download units concurrently and write each one, with its completion record, in its own transaction"""
+    counties = county_cache(cursor)
+    pending_units = iter(units)
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Workers stream responses to the on-disk cache; this thread parses them back one case at a time
+        in_flight = {executor.submit(fetch_unit, unit) for unit in islice(pending_units, max_workers)}
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                unit, downloaded = future.result()
+                if not downloaded:
+                    # Left unrecorded so the next run retries it
+                    print(f"Failed to fetch {unit_key(unit)}")
+                    failed += 1
+                else:
+                    num_cases = insert_crash_stream(cursor, counties, iter_case_list(*unit_request(unit)))
+                    set_state(cursor, unit_key(unit), num_cases)
+                    conn.commit()
+                    print(f"Loaded {num_cases} crashes for {unit_key(unit)}")
+
+                next_unit = next(pending_units, None)
+                if next_unit is not None:
+                    in_flight.add(executor.submit(fetch_unit, next_unit))
+    return failed
+
+def parse_vehicle_range(value):
+    """Parse a MIN-MAX vehicle count range"""
+    min_vehicles, max_vehicles = value.split('-')
+    return int(min_vehicles), int(max_vehicles)
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill GetCaseList for many states and years")
+    parser.add_argument('--states', type=int, nargs='+', default=[26], help="state FIPS codes")
+    parser.add_argument('--all-states', action='store_true', help="every state plus DC")
+    parser.add_argument('--start-year', type=int, default=2010)
+    parser.add_argument('--end-year', type=int, default=2023)
+    parser.add_argument('--vehicle-ranges', type=parse_vehicle_range, nargs='+',
+                        default=DEFAULT_VEHICLE_RANGES, help="vehicle count ranges such as 1-1 2-2 3-6")
+    parser.add_argument('--workers', type=int, default=4, help="units fetched at the same time")
+    args = parser.parse_args()
+
+    conn = database.get_connection()
+    cursor = conn.cursor()
+    create_counties_table(cursor)
+    create_crashes_table(cursor)
+    conn.commit()
+    migrate(conn)
+
+    states = ALL_STATES if args.all_states else args.states
+    units = plan_units(cursor, states, args.start_year, args.end_year, args.vehicle_ranges)
+    print(f"{len(units)} work units to load")
+    failed = run_units(conn, cursor, units, args.workers)
+    database.close()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,158 @@
+import argparse
+
+import numpy as np
+
+import database
+from migrations import migrate, table_exists
+
+# Binning variable -> weather column
+VARIABLES = {
+    'tavg': 'temperature_avg',
+    'tmin': 'temperature_min',
+    'tmax': 'temperature_max',
+}
+
+def county_weather_coverage(cursor, counties=None, first_day=None, last_day=None):
+    """Return (county-days with station weather, county-days) over a span of days
+
+    counties defaults to every county with a crash and the span to the days crashes were loaded for.
+    """
+    if first_day is None:
+        cursor.execute('SELECT MIN(day), MAX(day) FROM daily_crash_stats')
+        first_day, last_day = cursor.fetchone()
+        if first_day is None:
+            return 0, 0
+    if counties is None:
+        county_filter, params = 'SELECT county_id FROM daily_crash_stats WHERE county_id IS NOT NULL', []
+    else:
+        county_filter, params = ', '.join('?' * len(counties)), list(counties)
+    cursor.execute(f'SELECT COUNT(DISTINCT county_id) FROM counties WHERE county_id IN ({county_filter})', params)
+    total = cursor.fetchone()[0] * (last_day - first_day + 1)
+    if not total or not table_exists(cursor, 'daily_weather'):
+        return 0, total
+    # daily_weather holds at most one row per station and day
+    cursor.execute(f'''
+        SELECT COUNT(*)
+        FROM county_weather_stations
+        JOIN daily_weather ON daily_weather.station_id = county_weather_stations.station_id
+        WHERE county_weather_stations.county_id IN ({county_filter})
+            AND daily_weather.day BETWEEN ? AND ?
+    ''', [*params, first_day, last_day])
+    return cursor.fetchone()[0], total
+
+def has_county_weather(cursor, counties=None, first_day=None, last_day=None):
+    """Check whether station weather covers every county-day, as loaded by weather.py --by-county
+
+    With only part of them covered the analysis stays on Detroit weather, since the
+    county-days without a station would otherwise drop out of it.
+    """
+    covered, total = county_weather_coverage(cursor, counties, first_day, last_day)
+    return total > 0 and covered == total
+
+def weather_source(cursor):
+    """Describe the weather the analysis uses, with the station coverage when it is partial"""
+    covered, total = county_weather_coverage(cursor)
+    if total > 0 and covered == total:
+        return "Using per-county station weather"
+    if covered:
+        return (f"Using Detroit weather: station weather covers only {covered} of {total} "
+                f"crash county-days ({covered / total:.0%})")
+    return "Using Detroit weather"
+
+def fetch_daily_fatal_crashes(cursor):
+    """Return {variable: temperatures, 'fatal_crashes': counts} arrays with one entry per weather day
+
+    Days without a fatal crash are included with a count of 0, limited to the span of days
+    crashes were loaded for. With per-county weather covering every crash county each entry is
+    a county-day matched to that county's station; otherwise it is a day of Detroit weather
+    against every crash that day.
+    """
+    columns = ', '.join(f'weather.{column}' for column in VARIABLES.values())
+    crash_span = '''
+        weather.day BETWEEN (SELECT MIN(day) FROM daily_crash_stats) AND (SELECT MAX(day) FROM daily_crash_stats)'''
+    if has_county_weather(cursor):
+        cursor.execute(f'''
+            SELECT
+                {columns},
+                COALESCE(daily_crash_stats.fatal_crashes, 0)
+            FROM
+                county_weather_stations
+            JOIN
+                daily_weather weather
+            ON
+                weather.station_id = county_weather_stations.station_id
+            LEFT JOIN
+                daily_crash_stats
+            ON
+                daily_crash_stats.county_id = county_weather_stations.county_id
+                AND daily_crash_stats.day = weather.day
+            WHERE
+                {crash_span}
+        ''')
+    else:
+        cursor.execute(f'''
+            SELECT
+                {columns},
+                COALESCE(SUM(daily_crash_stats.fatal_crashes), 0)
+            FROM
+                daily_data_meteostat weather
+            LEFT JOIN
+                daily_crash_stats
+            ON
+                daily_crash_stats.day = weather.day
+            WHERE
+                {crash_span}
+            GROUP BY
+                weather.day
+        ''')
+    # NULL readings become NaN and are left out when binning
+    data = np.array(cursor.fetchall(), dtype=float).reshape(-1, len(VARIABLES) + 1)
+    daily = {variable: data[:, i] for i, variable in enumerate(VARIABLES)}
+    daily['fatal_crashes'] = data[:, -1]
+    return daily
+
+def bin_label(low, width):
+    """Label of the bin [low, low + width)"""
+    return f'{low:g} to {low + width:g}'
+
+def bin_days(temperatures, values, width=10, origin=0):
+    """Bucket days into [origin + k * width, origin + (k + 1) * width) bins in one pass
+
+    Returns (label, sum of values, days) for every bin with at least one day, coldest first.
+    """
+    valid = ~np.isnan(temperatures)
+    index = np.floor((temperatures[valid] - origin) / width).astype(np.int64)
+    bins, inverse = np.unique(index, return_inverse=True)
+    totals = np.bincount(inverse, weights=values[valid], minlength=len(bins))
+    days = np.bincount(inverse, minlength=len(bins))
+    return [(bin_label(origin + int(k) * width, width), int(total), int(count))
+            for k, total, count in zip(bins, totals, days)]
+
+def sweep(daily, widths, variables=tuple(VARIABLES), origin=0):
+    """Bin the same daily data under every (variable, width) pair"""
+    return {
+        (variable, width): bin_days(daily[variable], daily['fatal_crashes'], width, origin)
+        for variable in variables
+        for width in widths
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Average fatal crashes per day for many temperature binnings")
+    parser.add_argument('--variables', nargs='+', choices=list(VARIABLES), default=['tavg'])
+    parser.add_argument('--widths', type=float, nargs='+', default=[10], help="bin widths in degrees F")
+    parser.add_argument('--origin', type=float, default=0, help="temperature every bin edge is aligned to")
+    args = parser.parse_args()
+
+    conn = database.get_connection()
+    migrate(conn)
+    print(weather_source(conn.cursor()))
+    daily = fetch_daily_fatal_crashes(conn.cursor())
+    database.close()
+
+    for (variable, width), bins in sweep(daily, args.widths, args.variables, args.origin).items():
+        print(f"\n{variable}, {width:g} degree bins:")
+        for label, crashes, days in bins:
+            print(f"   - {label:>12}: {crashes / days:.3f} fatal crashes per day over {days} days")
+
+if __name__ == "__main__":
+    main()
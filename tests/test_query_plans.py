@@ -0,0 +1,27 @@
+import benchmarks
+import database
+from migrations import migrate
+from query_plans import check_query_plans
+
+def build_database(path, num_rows=2000):
+    """Small synthetic database with every table the analysis queries read, not yet migrated"""
+    conn = database.connect(str(path))
+    cursor = conn.cursor()
+    benchmarks.create_tables(cursor)
+    benchmarks.generate_dimensions(cursor)
+    benchmarks.generate_weather(cursor)
+    benchmarks.generate_crashes(cursor, num_rows)
+    conn.commit()
+    return conn
+
+def test_migrated_queries_use_indexes(tmp_path):
+    conn = build_database(tmp_path / 'proj_data.db')
+    migrate(conn)
+    assert check_query_plans(conn) == []
+    conn.close()
+
+def test_unmigrated_queries_are_reported(tmp_path):
+    # Without the analysis indexes the check must find full scans, or it checks nothing
+    conn = build_database(tmp_path / 'proj_data.db')
+    assert check_query_plans(conn) != []
+    conn.close()
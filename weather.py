@@ -1,8 +1,25 @@
+import argparse
+import csv
+import io
+import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from meteostat import Point, Daily
-import sqlite3
+from meteostat import Point, Daily, Stations
+import requests
 import pandas as pd
 
+import database
+import instrumentation
+from ingest_state import bump_version, get_state, set_state
+from instrumentation import instrumented
+from migrations import migrate, table_exists
+
+EPOCH = pd.Timestamp(1970, 1, 1)
+
+# Census county internal points, used to place each crash county on the map
+GAZETTEER_URL = "https://www2.census.gov/geo/docs/maps-data/data/gazetteer/2020_Gazetteer/2020_Gaz_counties_national.zip"
+
 def convert_to_fahrenheit(temp):
     """Convert temperature from Celsius to Fahrenheit"""
     return (temp * 9/5) + 32
@@ -16,10 +33,58 @@ def create_database_table(cursor):
             temperature_avg REAL,
             temperature_min REAL,
             temperature_max REAL,
+            day INTEGER,
             UNIQUE(date) ON CONFLICT IGNORE
         )
     ''')
 
+def create_weather_station_tables(cursor):
+    """Create the per-station weather tables in the database if not exists"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS weather_stations (
+            station_id TEXT PRIMARY KEY,
+            name TEXT,
+            latitude REAL,
+            longitude REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS county_weather_stations (
+            county_id INTEGER PRIMARY KEY,
+            station_id TEXT,
+            latitude REAL,
+            longitude REAL,
+            FOREIGN KEY (county_id) REFERENCES counties(county_id),
+            FOREIGN KEY (station_id) REFERENCES weather_stations(station_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_weather (
+            station_id TEXT,
+            day INTEGER,
+            date TEXT,
+            temperature_avg REAL,
+            temperature_min REAL,
+            temperature_max REAL,
+            PRIMARY KEY (station_id, day) ON CONFLICT IGNORE,
+            FOREIGN KEY (station_id) REFERENCES weather_stations(station_id)
+        )
+    ''')
+
+def daily_rows(data):
+    """Turn a Meteostat daily DataFrame into (date, avg, min, max, day) rows in Fahrenheit"""
+    # Convert whole columns at once and build the rows without touching them one by one
+    rows = pd.DataFrame({
+        'date': data.index.strftime('%Y-%m-%d'),
+        'temperature_avg': convert_to_fahrenheit(data['tavg']).to_numpy(),
+        'temperature_min': convert_to_fahrenheit(data['tmin']).to_numpy(),
+        'temperature_max': convert_to_fahrenheit(data['tmax']).to_numpy(),
+        'day': (data.index.normalize() - EPOCH).days,
+    })
+    # Missing readings go in as NULL
+    return rows.astype(object).where(rows.notna(), None)
+
+@instrumented(rows='result')
 def fetch_and_insert_data(cursor, start_date, end_date):
     """Fetch and insert Meteostat data into the database"""
     # Create Point for Detroit, MI
@@ -28,54 +93,199 @@ def fetch_and_insert_data(cursor, start_date, end_date):
     # Get daily data for the specified date range
     data = Daily(detroit, start_date, end_date).fetch()
 
+    if data.empty:
+        return 0
+    rows = daily_rows(data)
+
     # Insert unique Meteostat data into the database
-    for index, row in data.iterrows():
-        date_value = index.date()
-        temperature_avg = convert_to_fahrenheit(row['tavg'])
-        temperature_min = convert_to_fahrenheit(row['tmin'])
-        temperature_max = convert_to_fahrenheit(row['tmax'])
+    cursor.executemany('''
+        INSERT OR IGNORE INTO daily_data_meteostat
+            (date, temperature_avg, temperature_min, temperature_max, day)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows.itertuples(index=False, name=None))
+    return len(rows)
+
+def load_county_locations(path=None):
+    """Return {(state code, county code): (latitude, longitude)} from the Census gazetteer file"""
+    if path is None:
+        response = requests.get(GAZETTEER_URL, timeout=60)
+        response.raise_for_status()
+        raw = response.content
+    else:
+        with open(path, 'rb') as file:
+            raw = file.read()
+    if raw[:2] == b'PK':
+        with zipfile.ZipFile(io.BytesIO(raw)) as archive:
+            raw = archive.read(archive.namelist()[0])
+
+    locations = {}
+    reader = csv.reader(io.StringIO(raw.decode('latin-1')), delimiter='\t')
+    header = [column.strip() for column in next(reader)]
+    geoid, lat, lon = header.index('GEOID'), header.index('INTPTLAT'), header.index('INTPTLONG')
+    for row in reader:
+        locations[(int(row[geoid][:2]), int(row[geoid][2:]))] = (float(row[lat]), float(row[lon].strip()))
+    return locations
+
+def county_code(county_name):
+    """Pull the county FIPS code out of a NHTSA county name such as 'WAYNE (163)'"""
+    match = re.search(r'\((\d+)\)\s*$', county_name)
+    return int(match.group(1)) if match else None
+
+def map_counties_to_stations(cursor, start_date, end_date, gazetteer=None):
+    """Assign every crash county without a station the nearest station with daily data for the period"""
+    if not table_exists(cursor, 'crashes'):
+        print("No crashes loaded yet, so there are no counties to map; run ingest-crashes first")
+        return 0
+    cursor.execute('''
+        SELECT DISTINCT crashes.county_id, counties.county_name, crashes.State
+        FROM crashes
+        JOIN counties ON counties.county_id = crashes.county_id
+        WHERE crashes.county_id NOT IN (SELECT county_id FROM county_weather_stations)
+    ''')
+    unmapped = cursor.fetchall()
+    if not unmapped:
+        return 0
+
+    locations = load_county_locations(gazetteer)
+    mapped = 0
+    for county_id, county_name, state in unmapped:
+        location = locations.get((state, county_code(county_name)))
+        if location is None:
+            print(f"No location for county {county_name} in state {state}")
+            continue
+        latitude, longitude = location
+        stations = Stations().nearby(latitude, longitude).inventory('daily', (start_date, end_date)).fetch(1)
+        if stations.empty:
+            print(f"No weather station with daily data near {county_name}")
+            continue
+        station_id = stations.index[0]
+        station = stations.iloc[0]
+        cursor.execute('''
+            INSERT OR IGNORE INTO weather_stations (station_id, name, latitude, longitude) VALUES (?, ?, ?, ?)
+        ''', (station_id, station['name'], float(station['latitude']), float(station['longitude'])))
         cursor.execute('''
-            INSERT OR IGNORE INTO daily_data_meteostat VALUES (NULL, ?, ?, ?, ?)
-        ''', (date_value, temperature_avg, temperature_min, temperature_max))
-
-def write_last_end_date(end_date):
-    """Write the last end date to a file for the next run"""
-    with open('last_end_date.txt', 'w') as file:
-        file.write(end_date.strftime('%Y-%m-%d'))
-
-def read_last_end_date():
-    """Read the last end date from the file or use an initial date"""
-    try:
-        with open('last_end_date.txt', 'r') as file:
-            last_end_date_str = file.read()
-        return datetime.strptime(last_end_date_str, '%Y-%m-%d')
-    except FileNotFoundError:
-        # If the file is not found, use an initial start date
+            INSERT OR REPLACE INTO county_weather_stations (county_id, station_id, latitude, longitude)
+            VALUES (?, ?, ?, ?)
+        ''', (county_id, station_id, latitude, longitude))
+        mapped += 1
+    if mapped:
+        # county_id is the rowid, so a replaced mapping changes neither MAX(rowid) nor COUNT(*)
+        bump_version(cursor, 'county_weather_stations')
+    return mapped
+
+@instrumented()
+def fetch_station_rows(station_id, start_date, end_date):
+    """Fetch one station's daily data as rows ready for daily_weather"""
+    data = Daily(station_id, start_date, end_date).fetch()
+    if data.empty:
+        return station_id, []
+    return station_id, [(station_id, *row) for row in daily_rows(data).itertuples(index=False, name=None)]
+
+def station_key(station_id):
+    """ingest_state pipeline name recording the last day loaded for a weather station"""
+    return f'weather_station:{station_id}'
+
+def station_start_dates(cursor, station_ids, start_date):
+    """First day to load for each station, going back before start_date for the days it missed
+
+    A station resumes the day after its own checkpoint, and one without a checkpoint, such
+    as a station just mapped to a county, starts from the first day any station was loaded for.
+    """
+    cursor.execute('SELECT MIN(day) FROM daily_weather')
+    first_day = cursor.fetchone()[0]
+    first_date = start_date if first_day is None else datetime(1970, 1, 1) + timedelta(days=first_day)
+    starts = {}
+    for station_id in station_ids:
+        loaded = get_state(cursor, station_key(station_id))
+        resume = first_date if loaded is None else datetime.strptime(loaded, '%Y-%m-%d') + timedelta(days=1)
+        starts[station_id] = min(start_date, resume)
+    return starts
+
+def fetch_and_insert_station_data(cursor, start_date, end_date, max_workers=8):
+    """Fetch daily data for every mapped station in parallel and insert it keyed by (station, day)"""
+    cursor.execute('SELECT DISTINCT station_id FROM county_weather_stations')
+    station_ids = [row[0] for row in cursor.fetchall()]
+    starts = station_start_dates(cursor, station_ids, start_date)
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Stations download in parallel; rows are written here as each one finishes
+        for station_id, rows in executor.map(lambda station: fetch_station_rows(station, starts[station], end_date),
+                                             station_ids):
+            cursor.executemany('''
+                INSERT OR IGNORE INTO daily_weather
+                    (station_id, date, temperature_avg, temperature_min, temperature_max, day)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            total += len(rows)
+            # Every station was loaded without a gap up to end_date, committed with its rows
+            loaded = get_state(cursor, station_key(station_id))
+            if loaded is None or end_date > datetime.strptime(loaded, '%Y-%m-%d'):
+                set_state(cursor, station_key(station_id), end_date.strftime('%Y-%m-%d'))
+    return total
+
+def read_last_end_date(cursor, pipeline='weather'):
+    """Read the last end date saved by the previous run or use an initial date"""
+    last_end_date_str = get_state(cursor, pipeline)
+    if last_end_date_str is None:
+        # If nothing was loaded yet, use an initial start date
         return datetime(2019, 12, 31)
+    return datetime.strptime(last_end_date_str, '%Y-%m-%d')
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Load Meteostat daily weather into proj_data.db")
+    parser.add_argument('--start', type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+                        help="first day to load (YYYY-MM-DD); defaults to the day after the last run")
+    parser.add_argument('--end', type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+                        help="last day to load (YYYY-MM-DD); defaults to 25 days after --start")
+    parser.add_argument('--by-county', action='store_true',
+                        help="load weather from the station nearest each crash county instead of Detroit")
+    parser.add_argument('--gazetteer', help="local copy of the Census county gazetteer file")
+    parser.add_argument('--workers', type=int, default=8, help="stations fetched in parallel")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.setup(args)
 
-def main():
     # SQLite database connection
-    conn = sqlite3.connect('proj_data.db')
+    conn = database.get_connection()
     cursor = conn.cursor()
 
-    # Create daily data table in the database if not exists
+    # Create daily data tables in the database if not exists
     create_database_table(cursor)
+    create_weather_station_tables(cursor)
     conn.commit()
+    migrate(conn)
 
-    # Read the last end date from the file or use an initial date
-    last_end_date = read_last_end_date()
+    # Read the last end date saved by the previous run or use an initial date
+    pipeline = 'weather_by_county' if args.by_county else 'weather'
+    last_end_date = read_last_end_date(cursor, pipeline)
 
     # Set time period for the current fetch
-    start_date_current = last_end_date + timedelta(days=1)
-    end_date_current = start_date_current + timedelta(days=24)  # Fetching 25 days in the current fetch
+    start_date_current = args.start or last_end_date + timedelta(days=1)
+    end_date_current = args.end or start_date_current + timedelta(days=24)  # Fetching 25 days by default
 
     # Fetch and insert data for the current period
-    fetch_and_insert_data(cursor, start_date_current, end_date_current)
-    conn.commit()
+    if args.by_county:
+        mapped = map_counties_to_stations(cursor, start_date_current, end_date_current, args.gazetteer)
+        print(f"Mapped {mapped} new counties to weather stations")
+        num_rows = fetch_and_insert_station_data(cursor, start_date_current, end_date_current, args.workers)
+        print(f"Loaded {num_rows} station days of weather")
+    else:
+        num_days = fetch_and_insert_data(cursor, start_date_current, end_date_current)
+        print(f"Loaded {num_days} days of weather")
 
-    # Write the last end date to a file for the next run
-    write_last_end_date(end_date_current)
-    conn.close()
+    # Save the last end date for the next run in the same transaction as the data, unless that
+    # would jump over days between the last run and this one that were never loaded. Stations
+    # resume from their own checkpoints, so only the Detroit load can leave such a gap.
+    if not args.by_county and start_date_current > last_end_date + timedelta(days=1):
+        print(f"Left the {pipeline} checkpoint at {last_end_date:%Y-%m-%d}, since "
+              f"{last_end_date + timedelta(days=1):%Y-%m-%d} to {start_date_current - timedelta(days=1):%Y-%m-%d} "
+              f"are not loaded yet")
+    elif end_date_current > last_end_date:
+        set_state(cursor, pipeline, end_date_current.strftime('%Y-%m-%d'))
+    with instrumentation.span('sqlite.commit'):
+        conn.commit()
+    database.close()
 
 if __name__ == "__main__":
     main()